@@ -0,0 +1,212 @@
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import time
+from collections import OrderedDict
+
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from theconf import Config as C
+
+from FastAutoAugment.common import get_logger, autocast, get_device, memory_format
+from FastAutoAugment.networks import get_model, num_class
+from FastAutoAugment.networks.efficientnet_pytorch import EfficientNet
+from FastAutoAugment.networks.efficientnet_pytorch.condconv import CondConv2d
+
+logger = get_logger('Fast AutoAugment')
+
+# name -> (model config, dataset), as in confs/
+ARCHITECTURES = OrderedDict([
+    ('wresnet40_2', ({'type': 'wresnet40_2'}, 'cifar10')),
+    ('wresnet28_10', ({'type': 'wresnet28_10'}, 'cifar10')),
+    ('shakeshake26_2x32d', ({'type': 'shakeshake26_2x32d'}, 'cifar10')),
+    ('shakeshake26_2x64d', ({'type': 'shakeshake26_2x64d'}, 'cifar10')),
+    ('shakeshake26_2x96d', ({'type': 'shakeshake26_2x96d'}, 'cifar10')),
+    ('shakeshake26_2x112d', ({'type': 'shakeshake26_2x112d'}, 'cifar10')),
+    ('shakeshake26_2x96d_next', ({'type': 'shakeshake26_2x96d_next'}, 'cifar10')),
+    ('pyramid272', ({'type': 'pyramid', 'depth': 272, 'alpha': 200, 'bottleneck': True}, 'cifar10')),
+    ('resnet50', ({'type': 'resnet50'}, 'imagenet')),
+    ('resnet200', ({'type': 'resnet200'}, 'imagenet')),
+    ('efficientnet-b0', ({'type': 'efficientnet-b0', 'condconv_num_expert': 1}, 'imagenet')),
+    ('efficientnet-b0_condconv', ({'type': 'efficientnet-b0', 'condconv_num_expert': 8}, 'imagenet')),
+    ('efficientnet-b1', ({'type': 'efficientnet-b1', 'condconv_num_expert': 1}, 'imagenet')),
+    ('efficientnet-b2', ({'type': 'efficientnet-b2', 'condconv_num_expert': 1}, 'imagenet')),
+    ('efficientnet-b3', ({'type': 'efficientnet-b3', 'condconv_num_expert': 1}, 'imagenet')),
+    ('efficientnet-b4', ({'type': 'efficientnet-b4', 'condconv_num_expert': 1}, 'imagenet')),
+])
+
+
+def input_size(model_conf, dataset):
+    if 'efficientnet' in model_conf['type']:
+        return EfficientNet.get_image_size(model_conf['type'])
+    return 224 if 'imagenet' in dataset else 32
+
+
+def count_macs(model, example):
+    """
+    multiply-accumulates per image of convolution and linear layers, counted with forward hooks on one eval forward.
+    """
+    macs, handles = [0], []
+
+    def hook(module, input, output):
+        if isinstance(module, nn.Conv2d):
+            macs[0] += output.numel() * module.weight[0].numel()
+        elif isinstance(module, CondConv2d):
+            macs[0] += output.numel() * (module.in_channels // module.groups) * module.kernel_size[0] * module.kernel_size[1]
+        elif isinstance(module, nn.Linear):
+            macs[0] += output.numel() * module.in_features
+
+    for m in model.modules():
+        if isinstance(m, (nn.Conv2d, CondConv2d, nn.Linear)):
+            handles.append(m.register_forward_hook(hook))
+    try:
+        with torch.no_grad():
+            model(example)
+    finally:
+        for h in handles:
+            h.remove()
+    return macs[0] // example.size(0)
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def throughput(step, batch, device, steps, warmup):
+    # images/sec of `step`, after `warmup` untimed calls
+    for _ in range(warmup):
+        step()
+    _synchronize(device)
+    start = time.time()
+    for _ in range(steps):
+        step()
+    _synchronize(device)
+    return batch * steps / (time.time() - start)
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2. ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10   # process peak rss, kB on linux
+
+
+def benchmark(name, batches, steps, warmup):
+    """
+    results of one architecture, for batch sizes in increasing order
+    (the cpu peak memory is the peak rss of the process, so it only grows).
+    """
+    model_conf, dataset = ARCHITECTURES[name]
+    C.get()['model'], C.get()['dataset'] = model_conf, dataset
+    device = get_device()
+    model = get_model(model_conf, num_class(dataset))
+    size = input_size(model_conf, dataset)
+    params = sum(p.numel() for p in model.parameters())
+    loss_fn = nn.CrossEntropyLoss()
+
+    model.eval()
+    macs = count_macs(model, torch.randn(1, 3, size, size, device=device).contiguous(memory_format=memory_format()))
+
+    results = []
+    for batch in sorted(batches):
+        data = torch.randn(batch, 3, size, size, device=device).contiguous(memory_format=memory_format())
+        label = torch.randint(num_class(dataset), (batch,), device=device)
+
+        def eval_step():
+            with torch.no_grad(), autocast():
+                model(data)
+
+        def forward_step():
+            with autocast():
+                model(data)
+
+        def forward_backward_step():
+            with autocast():
+                loss = loss_fn(model(data).float(), label)
+            loss.backward()
+            for p in model.parameters():
+                p.grad = None
+
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        result = OrderedDict([('model', name), ('batch', batch), ('input_size', size), ('params', params), ('macs', macs)])
+        model.eval()
+        result['eval_images_per_sec'] = throughput(eval_step, batch, device, steps, warmup)
+        model.train()
+        result['forward_images_per_sec'] = throughput(forward_step, batch, device, steps, warmup)
+        result['forward_backward_images_per_sec'] = throughput(forward_backward_step, batch, device, steps, warmup)
+        result['peak_memory_mb'] = peak_memory_mb(device)
+        logger.info(json.dumps(result))
+        results.append(result)
+    return results
+
+
+def _worker(name, conf, batches, steps, warmup, queue):
+    C.get()
+    C.get().conf = conf
+    try:
+        queue.put(benchmark(name, batches, steps, warmup))
+    except Exception as e:
+        logger.exception('%s failed.' % name)
+        queue.put([OrderedDict([('model', name), ('error', str(e))])])
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(pathlib.Path(__file__).parent), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='throughput, memory and size of the get_model architectures')
+    parser.add_argument('--models', type=str, nargs='+', default=list(ARCHITECTURES.keys()), choices=list(ARCHITECTURES.keys()))
+    parser.add_argument('--batch', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cpu', choices=['cpu', 'cuda'])
+    parser.add_argument('--num-threads', type=int, default=0)
+    parser.add_argument('--memory-format', type=str, default='contiguous_format', choices=['contiguous_format', 'channels_last'])
+    parser.add_argument('--amp', action='store_true')
+    parser.add_argument('--output', type=str, default='', help='json file, printed to stdout if not given')
+    args = parser.parse_args()
+
+    conf = {'device': args.device, 'num_threads': args.num_threads, 'memory_format': args.memory_format, 'amp': args.amp}
+    C.get()
+    C.get().conf = conf
+
+    # one process per architecture, so peak memory and allocator state are not shared between models
+    ctx = mp.get_context('spawn')
+    results = []
+    for name in args.models:
+        queue = ctx.SimpleQueue()
+        p = ctx.Process(target=_worker, args=(name, conf, args.batch, args.steps, args.warmup, queue))
+        p.start()
+        results.extend(queue.get())
+        p.join()
+
+    report = OrderedDict([
+        ('revision', git_revision()),
+        ('torch', torch.__version__),
+        ('platform', platform.platform()),
+        ('processor', platform.processor()),
+        ('device', torch.cuda.get_device_name() if get_device().type == 'cuda' else 'cpu'),
+        ('num_threads', args.num_threads or torch.get_num_threads()),
+        ('conf', conf),
+        ('steps', args.steps),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        logger.info('saved at %s' % args.output)
+    else:
+        print(json.dumps(report, indent=4))
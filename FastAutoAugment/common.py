@@ -1,6 +1,15 @@
 import copy
+import gzip
+import io
+import json
 import logging
+import os
+import queue
+import threading
 import warnings
+from collections import OrderedDict
+import ray
+import torch
 from ray import tune
 from theconf import Config as C
 
@@ -26,10 +35,259 @@ def add_filehandler(logger, filepath, level=logging.DEBUG):
     logger.addHandler(fh)
 
 
+def progress_path(save_path):
+    return save_path + '.progress'
+
+
+def write_progress(save_path, epoch):
+    # small sidecar next to the checkpoint, so drivers can follow training without torch.load-ing it.
+    path = progress_path(save_path)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'epoch': epoch}, f)
+    os.replace(tmp_path, path)
+
+
+def read_progress(save_path):
+    try:
+        with open(progress_path(save_path)) as f:
+            return json.load(f)['epoch']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_device():
+    """
+    torch.device of the `device` config: 'cuda' (default when available) or 'cpu'.
+    on cpu, intra-op parallelism is set to `num_threads` if given (ray workers start single-threaded).
+    """
+    name = C.get().conf.get('device', 'cuda' if torch.cuda.is_available() else 'cpu')
+    if name == 'cpu':
+        num_threads = C.get().conf.get('num_threads', 0)
+        if num_threads > 0 and torch.get_num_threads() != num_threads:
+            torch.set_num_threads(num_threads)
+    elif name != 'cuda':
+        raise ValueError('invalid device=%s' % name)
+    return torch.device(name)
+
+
+def device_count():
+    # devices used by one process; a cpu process counts as one device
+    return torch.cuda.device_count() if get_device().type == 'cuda' else 1
+
+
+def ray_resources(num_gpus):
+    """
+    ray remote options for a task taking `num_gpus` gpus, or `num_threads` cpus when running on cpu.
+    """
+    if get_device().type == 'cuda':
+        return {'num_gpus': num_gpus}
+    return {'num_gpus': 0, 'num_cpus': max(C.get().conf.get('num_threads', 1), 1)}
+
+
+def trial_resources(num_gpus):
+    # ray_resources in tune's resources_per_trial format
+    resources = ray_resources(num_gpus)
+    return {'cpu': resources.get('num_cpus', 1), 'gpu': resources['num_gpus']}
+
+
+def max_concurrent_trials(num_process_per_gpu):
+    if get_device().type == 'cuda':
+        return num_process_per_gpu * torch.cuda.device_count()
+    return max(int(ray.cluster_resources().get('CPU', 1)) // ray_resources(0)['num_cpus'], 1)
+
+
+def memory_format():
+    name = C.get().conf.get('memory_format', 'contiguous_format')
+    if name not in ('contiguous_format', 'channels_last'):
+        raise ValueError('invalid memory_format=%s' % name)
+    return getattr(torch, name)
+
+
+def autocast(enabled=None):
+    """
+    autocast context for the forward pass when `amp` is on: float16 on cuda, bfloat16 on cpu.
+    """
+    if enabled is None:
+        enabled = C.get().conf.get('amp', False)
+    if get_device().type == 'cuda':
+        return torch.autocast('cuda', dtype=torch.float16, enabled=enabled)
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+
+
+def grad_scaler():
+    # loss scaling is only needed for float16; a disabled scaler passes backward/step through unchanged.
+    return torch.cuda.amp.GradScaler(enabled=C.get().conf.get('amp', False) and get_device().type == 'cuda')
+
+
+class BackgroundGenerator(object):
+    """
+    applies `fn` to the items of `iterable` in a daemon thread, keeping at most `max_prefetch` results queued.
+    """
+    _done = object()
+
+    def __init__(self, iterable, fn, max_prefetch=2):
+        self.queue = queue.Queue(max_prefetch)
+        self.stopped = threading.Event()
+        self.device = torch.cuda.current_device() if torch.cuda.is_available() else None
+        self.thread = threading.Thread(target=self._run, args=(iterable, fn), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterable, fn):
+        if self.device is not None:
+            torch.cuda.set_device(self.device)
+        try:
+            for item in iterable:
+                if not self._put(fn(item)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._done)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is self._done:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def load_checkpoint(path, map_location=None):
+    """
+    torch.load that also reads gzip-compressed checkpoints written by CheckpointWriter.
+    without cuda, tensors are loaded to cpu.
+    """
+    if map_location is None and not torch.cuda.is_available():
+        map_location = 'cpu'
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if not compressed:
+        return torch.load(path, map_location=map_location)
+    with gzip.open(path, 'rb') as f:
+        return torch.load(io.BytesIO(f.read()), map_location=map_location)
+
+
+class CheckpointWriter(object):
+    """
+    runs checkpoint writes in a daemon thread, in submission order.
+    tensors in the arguments are copied to (pinned) cpu memory on the calling thread, so training can go on
+    modifying them; files are written to a temporary path and renamed into place, gzip-compressed if `compress`.
+    """
+    _stop = object()
+
+    def __init__(self, compress=False, max_pending=2):
+        self.compress = compress
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _snapshot(self, obj):
+        if torch.is_tensor(obj):
+            obj = obj.detach()
+            if obj.is_cuda:
+                return torch.empty(obj.size(), dtype=obj.dtype, pin_memory=True).copy_(obj, non_blocking=True)
+            return obj.clone()
+        if isinstance(obj, dict):
+            copied = obj.__class__() if isinstance(obj, OrderedDict) else {}
+            for k, v in obj.items():
+                copied[k] = self._snapshot(v)
+            if hasattr(obj, '_metadata'):   # state_dict version info
+                copied._metadata = copy.deepcopy(obj._metadata)
+            return copied
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v) for v in obj)
+        return obj
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop:
+                return
+            fn, args, event = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, obj, path):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        if self.compress:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                torch.save(obj, f)
+        else:
+            torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    def submit(self, fn, *args):
+        self._raise()
+        args = self._snapshot(args)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((fn, args, event))
+
+    def save(self, obj, path):
+        self.submit(self._write, obj, path)
+
+    def _join(self):
+        if self.thread is not None:
+            self.queue.put(self._stop)
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self._join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # pending writes are always finished; a write error is not raised over an exception already propagating
+        self._join()
+        if exc_type is None:
+            self._raise()
+
+
 class EMA:
-    def __init__(self, mu):
+    """
+    exponential moving average of a module's state_dict, kept in preallocated shadow tensors and updated in place
+    with multi-tensor kernels. integer buffers (e.g. num_batches_tracked) keep the value they had when first seen.
+    with `interval` k > 1 the average is updated every k-th step with decay mu**k.
+    """
+    def __init__(self, mu, interval=1):
         self.mu = mu
+        self.interval = interval
         self.shadow = {}
+        self.calls = 0
+        self._cache = None  # (module, shadow, module tensors, shadow tensors)
 
     def state_dict(self):
         return copy.deepcopy(self.shadow)
@@ -37,16 +295,36 @@ class EMA:
     def __len__(self):
         return len(self.shadow)
 
+    def _tensors(self, module):
+        if self._cache is not None and self._cache[0] is module and self._cache[1] is self.shadow:
+            return self._cache[2], self._cache[3]
+
+        values, averages = [], []
+        for name, x in module.state_dict().items():
+            if name not in self.shadow or self.shadow[name].shape != x.shape:
+                self.shadow[name] = x.clone()
+            if not x.is_floating_point():
+                continue
+            if self.shadow[name].dtype != x.dtype or self.shadow[name].device != x.device:
+                self.shadow[name] = self.shadow[name].to(x)
+            values.append(x)
+            averages.append(self.shadow[name])
+        self._cache = (module, self.shadow, values, averages)
+        return values, averages
+
+    @torch.no_grad()
     def __call__(self, module, step=None):
+        self.calls += 1
+        if (self.calls if step is None else step) % self.interval != 0:
+            return
+
         if step is None:
             mu = self.mu
         else:
             # see : https://www.tensorflow.org/versions/r1.15/api_docs/python/tf/train/ExponentialMovingAverage?hl=PL
             mu = min(self.mu, (1. + step) / (10 + step))
+        mu = mu ** self.interval
 
-        for name, x in module.state_dict().items():
-            if name in self.shadow:
-                new_average = (1.0 - mu) * x + mu * self.shadow[name]
-                self.shadow[name] = new_average.clone()
-            else:
-                self.shadow[name] = x.clone()
+        values, averages = self._tensors(module)
+        torch._foreach_mul_(averages, mu)
+        torch._foreach_add_(averages, values, alpha=1.0 - mu)
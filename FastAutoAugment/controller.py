@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 # from torch.autograd import Variable
-from torch.distributions.categorical import Categorical
 import numpy as np
 
 class Controller(nn.Module):
@@ -102,72 +101,45 @@ class Controller(nn.Module):
         entropys: batch of entropy, (tensor)[batch or 1]
         subpolicies: batch of sampled policies, (np.array)[batch, n_subpolicy, n_op, 3]
         """
-        log_probs = []
-        entropys = []
-        subpolicies = []
         self.hidden = None  # setting state to None will initialize LSTM state with 0s
+        gr_log_prob = None
         if self.img_input:
             inputs = self.conv_input(image)                 # [batch, lstm_size]
             if self.n_group > 0:
                 gr_vectors = self.logit2group(inputs)
                 gr_log_prob, gr_ids = gr_vectors.max(1)
                 inputs = self.gr_emb(gr_ids)
-                log_probs.append(self.gr_prob_weight * gr_log_prob)
         else:
             # inputs = self.in_emb.weight                     # [1, lstm_size]
             if self.n_group > 0:
-                gr_ids = torch.randint(low=0, high=self.n_group, size=(len(image),)).cuda()
+                gr_ids = torch.randint(low=0, high=self.n_group, size=(len(image),), device=image.device)
                 inputs = self.gr_emb(gr_ids)
         inputs = inputs.unsqueeze(0)                        # [1, batch(or 1), lstm_size]
+        batch_size = inputs.size(1)
+        # everything stays on the device until the sampled ids are copied to host once, at the end
+        ids = torch.empty(self.n_subpolicy, self.n_op, 3, batch_size, dtype=torch.long, device=inputs.device)
+        log_probs = inputs.new_empty(self.n_subpolicy * self.n_op * 3, batch_size)
+        entropys = inputs.new_empty(self.n_subpolicy * self.n_op * 3, batch_size)
+        # (operation type o, probability p, magnitude m) tokens of each op
+        tokens = [(self.o_logit, self.o_emb), (self.p_logit, self.p_emb), (self.m_logit, self.m_emb)]
+        step = 0
         for i_subpol in range(self.n_subpolicy):
-            subpolicy = []
             for i_op in range(self.n_op):
-                # sample operation type, o
-                output, self.hidden = self.lstm(inputs, self.hidden)        # [1, batch, lstm_size]
-                output = output.squeeze(0)                      # [batch, lstm_size]
-                logit = self.o_logit(output)                    # [batch, _operation_types]
-                logit = self.softmax_tanh(logit)
-                o_id_dist = Categorical(logits=logit)
-                o_id = o_id_dist.sample()                       # [batch]
-                log_prob = o_id_dist.log_prob(o_id)             # [batch]
-                entropy = o_id_dist.entropy()                   # [batch]
-                log_probs.append(log_prob)
-                entropys.append(entropy)
-                inputs = self.o_emb(o_id)                       # [batch, lstm_size]
-                inputs = inputs.unsqueeze(0)                    # [1, batch, lstm_size]
-                # sample operation probability, p
-                output, self.hidden = self.lstm(inputs, self.hidden)
-                output = output.squeeze(0)
-                logit = self.p_logit(output)
-                logit = self.softmax_tanh(logit)
-                p_id_dist = Categorical(logits=logit)
-                p_id = p_id_dist.sample()
-                log_prob = p_id_dist.log_prob(p_id)
-                entropy = p_id_dist.entropy()
-                log_probs.append(log_prob)
-                entropys.append(entropy)
-                inputs = self.p_emb(p_id)
-                inputs = inputs.unsqueeze(0)
-                # sample operation magnitude, m
-                output, self.hidden = self.lstm(inputs, self.hidden)
-                output = output.squeeze(0)
-                logit = self.m_logit(output)
-                logit = self.softmax_tanh(logit)
-                m_id_dist = Categorical(logits=logit)
-                m_id = m_id_dist.sample()
-                log_prob = m_id_dist.log_prob(m_id)
-                entropy = m_id_dist.entropy()
-                log_probs.append(log_prob)
-                entropys.append(entropy)
-                inputs = self.m_emb(m_id)
-                inputs = inputs.unsqueeze(0)
-
-                subpolicy.append([o_id.detach().cpu().numpy(), p_id.detach().cpu().numpy(), m_id.detach().cpu().numpy()])
-            subpolicies.append(subpolicy)
-        sampled_policies = np.array(subpolicies)                    # (np.array) [n_subpolicy, n_op, 3, batch]
-        self.sampled_policies = np.moveaxis(sampled_policies,-1,0)  # (np.array) [batch, n_subpolicy, n_op, 3]
-        self.log_probs = sum(log_probs)                             # (tensor) [batch]
-        self.entropys = sum(entropys)                               # (tensor) [batch]
+                for i_token, (to_logit, to_emb) in enumerate(tokens):
+                    output, self.hidden = self.lstm(inputs, self.hidden)        # [1, batch, lstm_size]
+                    logit = self.softmax_tanh(to_logit(output.squeeze(0)))      # [batch, n_class]
+                    log_p = F.log_softmax(logit, dim=-1)
+                    token_id = torch.multinomial(log_p.exp(), 1)                # [batch, 1]
+                    log_probs[step] = log_p.gather(1, token_id).squeeze(1)
+                    entropys[step] = -(log_p.exp() * log_p).sum(1)
+                    ids[i_subpol, i_op, i_token] = token_id.squeeze(1)
+                    inputs = to_emb(token_id.squeeze(1)).unsqueeze(0)           # [1, batch, lstm_size]
+                    step += 1
+        self.sampled_policies = ids.permute(3, 0, 1, 2).cpu().numpy()  # (np.array) [batch, n_subpolicy, n_op, 3]
+        self.log_probs = log_probs.sum(0)                               # (tensor) [batch]
+        if gr_log_prob is not None:
+            self.log_probs = self.log_probs + self.gr_prob_weight * gr_log_prob
+        self.entropys = entropys.sum(0)                                 # (tensor) [batch]
         return self.log_probs, self.entropys, self.sampled_policies
 
 class RandAug(object):
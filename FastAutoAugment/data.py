@@ -10,6 +10,7 @@ import torchvision
 from PIL import Image
 
 from torch.utils.data import Dataset, SubsetRandomSampler, Sampler, Subset, ConcatDataset
+from torch.utils.data.dataloader import default_collate
 import torch.distributed as dist
 from torchvision.transforms import transforms
 from sklearn.model_selection import StratifiedShuffleSplit, PredefinedSplit
@@ -17,7 +18,7 @@ from theconf import Config as C
 
 from FastAutoAugment.archive import arsaug_policy, autoaug_policy, autoaug_paper_cifar10, fa_reduced_cifar10, fa_reduced_svhn, fa_resnet50_rimagenet
 from FastAutoAugment.augmentations import *
-from FastAutoAugment.common import get_logger
+from FastAutoAugment.common import get_logger, memory_format, get_device, device_count
 from FastAutoAugment.imagenet import ImageNet
 from FastAutoAugment.networks.efficientnet_pytorch.model import EfficientNet
 
@@ -191,11 +192,11 @@ def get_gr_dist(dataset, batch, dataroot, split_idx=0, multinode=False, target_l
         transform_train = transforms.Compose([
             transforms.RandomCrop(32, padding=4),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
         transform_test = transforms.Compose([
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
     elif 'imagenet' in dataset:
@@ -219,7 +220,7 @@ def get_gr_dist(dataset, batch, dataroot, split_idx=0, multinode=False, target_l
                 contrast=0.4,
                 saturation=0.4,
             ),
-            transforms.ToTensor(),
+            ToTensor(),
             Lighting(0.1, _IMAGENET_PCA['eigval'], _IMAGENET_PCA['eigvec']),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
@@ -227,7 +228,7 @@ def get_gr_dist(dataset, batch, dataroot, split_idx=0, multinode=False, target_l
         transform_test = transforms.Compose([
             EfficientNetCenterCrop(input_size),
             transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
@@ -237,7 +238,7 @@ def get_gr_dist(dataset, batch, dataroot, split_idx=0, multinode=False, target_l
         transform_train = transform_test
     elif C.get()['aug'] == "nonorm":
         transform_train = transforms.Compose([
-            transforms.ToTensor()
+            ToTensor()
         ])
     train_idx = valid_idx = None
     if dataset == 'cifar10':
@@ -339,7 +340,7 @@ def get_gr_dist(dataset, batch, dataroot, split_idx=0, multinode=False, target_l
     if gr_assign is not None and total_trainset.gr_ids is None:
         temp_trainset = copy.deepcopy(total_trainset)
         temp_loader = torch.utils.data.DataLoader(
-            temp_trainset, batch_size=batch*torch.cuda.device_count(), shuffle=False, num_workers=4,
+            temp_trainset, batch_size=batch*device_count(), shuffle=False, num_workers=4,
             drop_last=False)
         gr_dist = gr_assign(temp_loader)
     return gr_dist, transform_train
@@ -353,11 +354,11 @@ def get_post_dataloader(dataset, batch, dataroot, split, split_idx, gr_id, gr_id
         transform_train = transforms.Compose([
             transforms.RandomCrop(32, padding=4),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
         transform_test = transforms.Compose([
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
     elif 'imagenet' in dataset:
@@ -381,7 +382,7 @@ def get_post_dataloader(dataset, batch, dataroot, split, split_idx, gr_id, gr_id
                 contrast=0.4,
                 saturation=0.4,
             ),
-            transforms.ToTensor(),
+            ToTensor(),
             Lighting(0.1, _IMAGENET_PCA['eigval'], _IMAGENET_PCA['eigvec']),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
@@ -389,7 +390,7 @@ def get_post_dataloader(dataset, batch, dataroot, split, split_idx, gr_id, gr_id
         transform_test = transforms.Compose([
             EfficientNetCenterCrop(input_size),
             transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
@@ -430,7 +431,7 @@ def get_post_dataloader(dataset, batch, dataroot, split, split_idx, gr_id, gr_id
         transform_train = transform_test
     elif C.get()['aug'] == "nonorm":
         transform_train = transforms.Compose([
-            transforms.ToTensor()
+            ToTensor()
         ])
     train_idx = valid_idx = None
     if dataset == 'cifar10':
@@ -551,18 +552,29 @@ def get_post_dataloader(dataset, batch, dataroot, split, split_idx, gr_id, gr_id
     valid_sampler = SubsetSampler(valid_idx)
 
     # trainloader = torch.utils.data.DataLoader(
-    #     total_trainset, batch_size=batch, shuffle=True if train_sampler is None else False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
+    #     total_trainset, batch_size=batch, shuffle=True if train_sampler is None else False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=get_device().type == 'cuda',
     #     sampler=train_sampler, drop_last=True)
     validloader = torch.utils.data.DataLoader(
-        total_trainset, batch_size=batch, shuffle=False, num_workers=4, pin_memory=True,
-        sampler=valid_sampler, drop_last=False)
+        total_trainset, batch_size=batch, shuffle=False, num_workers=4, pin_memory=get_device().type == 'cuda',
+        sampler=valid_sampler, drop_last=False, collate_fn=collate)
     # testloader = torch.utils.data.DataLoader(
-    #     testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
+    #     testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=get_device().type == 'cuda',
     #     drop_last=False
     # )
     return validloader
 
 
+def get_normalization(dataset):
+    """ (mean, std) of the Normalize transform of `dataset`, as in get_dataloaders. """
+    if 'cifar' in dataset:
+        return _CIFAR_MEAN, _CIFAR_STD
+    elif 'svhn' in dataset:
+        return _SVHN_MEAN, _SVHN_STD
+    elif 'imagenet' in dataset:
+        return (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    raise ValueError('dataset=%s' % dataset)
+
+
 def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode=False, target_lb=-1, gr_assign=None, gr_id=None, gr_ids=None, rand_val=False):
     if 'cifar' in dataset or 'svhn' in dataset:
         if "cifar" in dataset:
@@ -572,11 +584,11 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         transform_train = transforms.Compose([
             transforms.RandomCrop(32, padding=4),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
         transform_test = transforms.Compose([
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_mean, _std),
         ])
     elif 'imagenet' in dataset:
@@ -600,7 +612,7 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
                 contrast=0.4,
                 saturation=0.4,
             ),
-            transforms.ToTensor(),
+            ToTensor(),
             Lighting(0.1, _IMAGENET_PCA['eigval'], _IMAGENET_PCA['eigvec']),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
@@ -608,7 +620,7 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         transform_test = transforms.Compose([
             EfficientNetCenterCrop(input_size),
             transforms.Resize((input_size, input_size), interpolation=Image.BICUBIC),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
@@ -649,7 +661,7 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
         transform_train = transform_test
     elif C.get()['aug'] == "nonorm":
         transform_train = transforms.Compose([
-            transforms.ToTensor()
+            ToTensor()
         ])
     train_idx = valid_idx = None
     if dataset == 'cifar10':
@@ -814,18 +826,54 @@ def get_dataloaders(dataset, batch, dataroot, split=0.15, split_idx=0, multinode
 
 
     trainloader = torch.utils.data.DataLoader(
-        total_trainset, batch_size=batch, shuffle=True if train_sampler is None else False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
-        sampler=train_sampler, drop_last=True)
+        total_trainset, batch_size=batch, shuffle=True if train_sampler is None else False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=get_device().type == 'cuda',
+        sampler=train_sampler, drop_last=True, collate_fn=collate)
     validloader = torch.utils.data.DataLoader(
-        total_trainset, batch_size=batch, shuffle=False, num_workers=4, pin_memory=True,
-        sampler=valid_sampler, drop_last=False if not rand_val else True)
+        total_trainset, batch_size=batch, shuffle=False, num_workers=4, pin_memory=get_device().type == 'cuda',
+        sampler=valid_sampler, drop_last=False if not rand_val else True, collate_fn=collate)
     testloader = torch.utils.data.DataLoader(
-        testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=True,
-        drop_last=False
+        testset, batch_size=batch, shuffle=False, num_workers=8 if torch.cuda.device_count()==8 else 4, pin_memory=get_device().type == 'cuda',
+        drop_last=False, collate_fn=collate
     )
     return train_sampler, trainloader, validloader, testloader
 
 
+class ToTensor(object):
+    """
+    transforms.ToTensor. with `memory_format: channels_last` the HWC array of the image is only viewed as (C, H, W)
+    instead of being copied into CHW order, so images (and batches made by `stack_images`) come out channels_last.
+    """
+    def __init__(self):
+        self.channels_last = memory_format() == torch.channels_last
+        self.to_tensor = transforms.ToTensor()
+
+    def __call__(self, pic):
+        if not self.channels_last or not isinstance(pic, Image.Image) or pic.mode not in ('RGB', 'L'):
+            return self.to_tensor(pic)
+        img = torch.from_numpy(np.array(pic, np.uint8, copy=True))
+        if img.dim() == 2:
+            img = img.unsqueeze(2)
+        return img.permute(2, 0, 1).float().div_(255)
+
+
+def stack_images(imgs):
+    """
+    torch.stack for (C, H, W) images, keeping the channels_last layout of images from ToTensor.
+    """
+    if imgs[0].dim() == 3 and imgs[0].size(0) > 1 and imgs[0].stride(0) == 1:
+        return torch.stack([img.permute(1, 2, 0) for img in imgs]).permute(0, 3, 1, 2)
+    return torch.stack(imgs)
+
+
+def collate(batch):
+    """
+    default_collate, with the images of (img, target, ...) samples stacked by `stack_images`.
+    """
+    if not torch.is_tensor(batch[0][0]):
+        return default_collate(batch)
+    return [stack_images([sample[0] for sample in batch])] + default_collate([sample[1:] for sample in batch])
+
+
 class CutoutDefault(object):
     """
     Reference : https://github.com/quark0/darts/blob/master/cnn/utils.py
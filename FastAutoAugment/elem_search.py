@@ -21,11 +21,12 @@ lib_dir = (Path("__file__").parent).resolve()
 if str(lib_dir) not in sys.path: sys.path.insert(0, str(lib_dir))
 from FastAutoAugment.archive import remove_deplicates, policy_decoder
 from FastAutoAugment.augmentations import augment_list
-from FastAutoAugment.common import get_logger, add_filehandler
-from FastAutoAugment.data import get_dataloaders, get_custom_dataloaders
+from FastAutoAugment.common import get_logger, add_filehandler, read_progress, get_device, ray_resources
+from FastAutoAugment.data import get_dataloaders
 from FastAutoAugment.metrics import Accumulator
 from FastAutoAugment.networks import get_model, num_class
-from FastAutoAugment.train import train_and_eval, train_controller, batch_policy_decoder, train_and_eval_ctl
+from FastAutoAugment.train import train_and_eval
+from FastAutoAugment.train_ctl import train_controller, batch_policy_decoder, train_and_eval_ctl
 from theconf import Config as C, ConfigArgumentParser
 from FastAutoAugment.controller import Controller, RandAug
 
@@ -123,14 +124,14 @@ if __name__ == '__main__':
     cv_num = args.cv_num
     copied_c = copy.deepcopy(C.get().conf)
 
-    dataloaders = get_custom_dataloaders(C.get()['dataset'], C.get()['batch'], C.get()['dataroot'], args.cv_ratio)
+    dataloaders = get_dataloaders(C.get()['dataset'], C.get()['batch'], C.get()['dataroot'], args.cv_ratio)
     logger.info('search augmentation policies, dataset=%s model=%s' % (C.get()['dataset'], C.get()['model']['type']))
     logger.info('----- Train without Augmentations cv=%d ratio(test)=%.1f -----' % (cv_num, args.cv_ratio))
     w.start(tag='train_no_aug')
     paths = [_get_path(C.get()['dataset'], C.get()['model']['type'], 'ratio%.1f_fold%d' % (args.cv_ratio, i)) for i in range(cv_num)]
     print(paths)
     reqs = [ # model training
-        train_model.remote(copy.deepcopy(copied_c), dataloaders, args.dataroot, C.get()['aug'], args.cv_ratio, i, save_path=paths[i], skip_exist=True)
+        train_model.options(**ray_resources(1)).remote(copy.deepcopy(copied_c), dataloaders, args.dataroot, C.get()['aug'], args.cv_ratio, i, save_path=paths[i], skip_exist=True)
         for i in range(cv_num)]
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
@@ -139,20 +140,15 @@ if __name__ == '__main__':
         while True:
             epochs_per_cv = OrderedDict()
             for cv_idx in range(cv_num):
-                try:
-                    latest_ckpt = torch.load(paths[cv_idx])
-                    if 'epoch' not in latest_ckpt:
-                        epochs_per_cv['cv%d' % (cv_idx + 1)] = C.get()['epoch']
-                        continue
-                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_ckpt['epoch']
-                except Exception as e:
-                    continue
+                latest_epoch = read_progress(paths[cv_idx])
+                if latest_epoch is not None:
+                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_epoch
             tqdm_epoch.set_postfix(epochs_per_cv)
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
@@ -174,7 +170,7 @@ if __name__ == '__main__':
         #     for cv_fold in range(cv_num):
                 # TODO: training controller -> search policy using lstm controller
         controller = Controller(n_subpolicy=args.num_policy, lstm_size=args.lstm_size, n_group=args.num_group, gr_prob_weight=args.gr_prob_weight,\
-                                img_input=not args.random_group).cuda()
+                                img_input=not args.random_group).to(get_device())
         metrics, baseline = train_controller(controller, dataloaders, paths[0], ctl_save_path)
     else:
         controller = RandAug(n_subpolicy=args.num_policy)
@@ -186,7 +182,7 @@ if __name__ == '__main__':
     # default_path = [_get_path(C.get()['dataset'], C.get()['model']['type'], 'ratio%.1f_default%d' % (args.cv_ratio, _), False) for _ in range(num_experiments)]
     augment_path = [_get_path(C.get()['dataset'], C.get()['model']['type'], 'ratio%.1f_augment%d' % (args.cv_ratio, _), False) for _ in range(num_experiments)]
     # reqs = [train_model.remote(copy.deepcopy(copied_c), dataloaders, args.dataroot, C.get()['aug'], 0.0, 0, save_path=default_path[_], skip_exist=True) for _ in range(num_experiments)] + \
-    reqs = [eval_controller.remote(copy.deepcopy(copied_c), controller, args.dataroot, 0.0, 0, save_path=augment_path[_]) for _ in range(num_experiments)]
+    reqs = [eval_controller.options(**ray_resources(1)).remote(copy.deepcopy(copied_c), controller, args.dataroot, 0.0, 0, save_path=augment_path[_]) for _ in range(num_experiments)]
             # [train_model.remote(copy.deepcopy(copied_c), dataloaders, args.dataroot, "fa_reduced_cifar10", 0.0, 0, save_path=augment_path[_]) for _ in range(num_experiments)] + \
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
@@ -201,19 +197,16 @@ if __name__ == '__main__':
                 #         epochs['default_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
                 # except:
                 #     pass
-                try:
-                    if os.path.exists(augment_path[exp_idx]):
-                        latest_ckpt = torch.load(augment_path[exp_idx])
-                        epochs['augment_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
-                except:
-                    pass
+                latest_epoch = read_progress(augment_path[exp_idx])
+                if latest_epoch is not None:
+                    epochs['augment_exp%d' % (exp_idx + 1)] = latest_epoch
 
             tqdm_epoch.set_postfix(epochs)
             if len(epochs) == num_experiments and min(epochs.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs) == num_experiments and min(epochs.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
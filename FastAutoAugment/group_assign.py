@@ -1,20 +1,25 @@
 import numpy as np
 import copy
+import glob
+import hashlib
+import os
 from collections import defaultdict
 from collections.abc import Iterable
 import torch
 from torch import nn, optim
 from torch.distributions import Categorical
+from torch.utils.data import Dataset, DataLoader, Subset, ConcatDataset
 from torchvision.transforms import transforms
-from FastAutoAugment.data import get_dataloaders, CutoutDefault, Augmentation
+from FastAutoAugment.data import get_dataloaders, CutoutDefault, Augmentation, ToTensor, stack_images
 from FastAutoAugment.networks import get_model, num_class
+from FastAutoAugment.common import load_checkpoint, autocast, get_device
 from theconf import Config as C
 _CIFAR_MEAN, _CIFAR_STD = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
 _SVHN_MEAN, _SVHN_STD = (0.4377, 0.4438, 0.4728), (0.1980, 0.2010, 0.1970)
 class ModelWrapper(nn.Module):
     def __init__(self, backbone, gr_num, mode="reinforce"):
         super(ModelWrapper, self).__init__()
-        backbone = backbone.cuda()
+        backbone = backbone.to(get_device())
         feature_extracter_list = list(backbone.children())[:-1]
         num_features = feature_extracter_list[-1].num_features # last: bn
         backbone.feature_out = True
@@ -35,23 +40,146 @@ class ModelWrapper(nn.Module):
         # torch.nn.init.uniform_(self.linear.weight, -1.0, 1.0)
 
     def forward(self, data, label=None):
-        data = data.cuda()
-        if label is None:
-            label = torch.zeros(len(data), 1)
+        data = data.to(get_device())
         feature = self.backbone(data)
-        label = label.reshape([-1,1]).float().cuda()
+        return self.head(feature, label)
+
+    def head(self, feature, label=None):
+        if label is None:
+            label = torch.zeros(len(feature), 1)
+        label = label.reshape([-1,1]).float().to(get_device())
         logits = nn.functional.softmax(self.linear(torch.cat([feature, label], 1)), dim=-1)
         return logits
 
+
+class IndexedDataset(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        return img, target, index
+
+
+class FeatureCache(object):
+    """
+    penultimate features of the frozen backbone, computed once per clean training image
+    and kept in a memory-mapped file(+ labels), indexed like the full training set.
+    features are always taken with the backbone in eval mode(running batchnorm statistics), so they do not depend on
+    the batch an image comes in. without the cache, GrSpliter.train runs the backbone in train mode(batch statistics).
+    `path` should be keyed by the backbone (see feature_cache_path): an existing cache of the same shape is reopened and
+    extended, labels and filled flags are kept next to it (see flush). caches of other backbones in the same directory are removed.
+    """
+    def __init__(self, backbone, num_features, path):
+        self.backbone = backbone
+        self.num_features = num_features
+        self.path = path
+        self.features = self.labels = self.filled = None
+
+    def _meta_path(self):
+        return self.path[:-len('.npy')] + '.meta.npz' if self.path.endswith('.npy') else self.path + '.meta.npz'
+
+    def _open(self, num_samples):
+        if self.features is not None:
+            assert len(self.features) == num_samples, 'feature cache built for %d samples, got %d' % (len(self.features), num_samples)
+            return
+        shape = (num_samples, self.num_features)
+        if os.path.exists(self.path) and os.path.exists(self._meta_path()):
+            features = np.load(self.path, mmap_mode='r+')
+            meta = np.load(self._meta_path())
+            if features.shape == shape and features.dtype == np.float32 and meta['filled'].shape == (num_samples,):
+                self.features, self.labels, self.filled = features, meta['labels'], meta['filled']
+                return
+            del features
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        prefix = os.path.join(os.path.dirname(os.path.abspath(self.path)), os.path.basename(self.path).split('.')[0] + '.')
+        for stale in glob.glob(prefix + '*.npy') + glob.glob(prefix + '*.meta.npz'):
+            os.remove(stale)
+        self.features = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32, shape=shape)
+        self.labels = np.zeros(num_samples, dtype=np.int64)
+        self.filled = np.zeros(num_samples, dtype=bool)
+
+    def flush(self):
+        # features are written before the filled flags that mark them
+        if self.features is None:
+            return
+        self.features.flush()
+        tmp_path = '%s.%d.tmp.npz' % (self._meta_path(), os.getpid())
+        np.savez(tmp_path, labels=self.labels, filled=self.filled)
+        os.replace(tmp_path, self._meta_path())
+
+    @torch.no_grad()
+    def _compute(self, data):
+        training = self.backbone.training
+        self.backbone.eval()
+        feature = self.backbone(data.to(get_device()))
+        self.backbone.train(training)
+        return feature.cpu().numpy()
+
+    def lookup(self, num_samples, index, data, label):
+        # data: clean(just normalized) images of `index`
+        self._open(num_samples)
+        index = index.numpy()
+        missing = ~self.filled[index]
+        if missing.any():
+            self.features[index[missing]] = self._compute(data[torch.from_numpy(missing)])
+            self.labels[index[missing]] = label.cpu().numpy()[missing]
+            self.filled[index[missing]] = True
+        return torch.from_numpy(self.features[index]).to(get_device())
+
+    def fill(self, dataloader, mean, std):
+        # features of the whole dataset of dataloader, loaded with its batch size, workers and collate_fn
+        dataset = dataloader.dataset
+        self._open(len(dataset))
+        if not self.filled.all():
+            transform = transforms.Compose([
+                ToTensor(),
+                transforms.Normalize(mean, std),
+            ])
+            missing = np.nonzero(~self.filled)[0].tolist()
+            loader = DataLoader(IndexedDataset(_clean_view(dataset, transform)), batch_size=dataloader.batch_size, sampler=missing,
+                                num_workers=dataloader.num_workers, collate_fn=dataloader.collate_fn, pin_memory=dataloader.pin_memory, drop_last=False)
+            for data, label, index in loader:
+                self.lookup(len(dataset), index, data, label)
+            self.flush()
+        return self.features, self.labels
+
+
+def feature_cache_path(base_path, ckpt_path):
+    """ FeatureCache file under base_path for the backbone loaded from ckpt_path, keyed by the checkpoint's path, size and mtime. """
+    stat = os.stat(ckpt_path)
+    key = '%s:%d:%d' % (os.path.abspath(ckpt_path), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(base_path, 'gr_features.%s.npy' % hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def _clean_view(dataset, transform):
+    view = copy.copy(dataset)
+    if isinstance(dataset, ConcatDataset):
+        view.datasets = [_clean_view(x, transform) for x in dataset.datasets]
+    elif isinstance(dataset, Subset):
+        view.dataset = _clean_view(dataset.dataset, transform)
+    else:
+        view.transform = transform
+        if hasattr(view, 'gr_ids'):
+            view.gr_ids = None
+    return view
+
 class GrSpliter(object):
     def __init__(self, childnet, gr_num,
                  ent_w=0.1, eps=1e-3,
                  eps_clip=0.1, mode="ppo",
-                 eval_step=20
+                 eval_step=20, feature_cache=None
                  ):
         self.mode = mode
         # self.childnet = childnet
-        self.model = nn.DataParallel(ModelWrapper(copy.deepcopy(childnet), gr_num, mode=self.mode)).cuda()
+        self.model = nn.DataParallel(ModelWrapper(copy.deepcopy(childnet), gr_num, mode=self.mode)).to(get_device())
+        if feature_cache is not None:
+            # backbone is frozen, so the head can be trained/evaluated on cached features
+            feature_cache = FeatureCache(self.model.module.backbone, self.model.module.num_features, feature_cache)
+        self.feature_cache = feature_cache
         if self.mode == "supervised":
             self.optimizer = optim.Adam(self.model.parameters(), lr = 5e-4, weight_decay=1e-4)
         else:
@@ -60,7 +188,7 @@ class GrSpliter(object):
         self.eps = eps
         self.eps_clip = eps_clip
         self.eval_step = eval_step
-        self.loss_fn = torch.nn.CrossEntropyLoss(reduction='none').cuda()
+        self.loss_fn = torch.nn.CrossEntropyLoss(reduction='none').to(get_device())
         self.transform = None
         # self.transform = transforms.Compose([
         #     transforms.RandomCrop(32, padding=4),
@@ -71,34 +199,43 @@ class GrSpliter(object):
         # if C.get()['cutout'] > 0 and C.get()['aug'] != "nocut":
         #     self.transform.transforms.append(CutoutDefault(C.get()['cutout']))
 
+    def _mean_std(self):
+        if "cifar" in C.get()["dataset"]:
+            return _CIFAR_MEAN, _CIFAR_STD
+        elif "svhn" in C.get()["dataset"]:
+            return _SVHN_MEAN, _SVHN_STD
+        raise ValueError('invalid dataset=%s' % C.get()["dataset"])
+
     def gr_assign(self, dataloader):
         # dataloader: just normaized data
         # TODO: DataParallel
         self.model.eval()
         all_gr_dist = []
+        if self.feature_cache is not None:
+            features, labels = self.feature_cache.fill(dataloader, *self._mean_std())
+            with torch.no_grad():
+                for i in range(0, len(features), dataloader.batch_size):
+                    feature = torch.from_numpy(features[i:i+dataloader.batch_size]).to(get_device())
+                    gr_dist = self.model.module.head(feature, torch.from_numpy(labels[i:i+dataloader.batch_size]))
+                    all_gr_dist.append(gr_dist.cpu())
+            return torch.cat(all_gr_dist)
         for data, label in dataloader:
-            data, label = data.cuda(), label.cuda()
+            data, label = data.to(get_device()), label.to(get_device())
             gr_dist = self.model(data, label)
             all_gr_dist.append(gr_dist.cpu().detach())
         return torch.cat(all_gr_dist)
 
-    def augmentation(self, data, gr_ids, policy):
+    def augmentation(self, data, policy, gr_num):
+        # augments the batch with every group's policy, returns [gr_num * batch, C, H, W] (group-major)
+        mean, std = self._mean_std()
+        imgs = data.cpu() * torch.tensor(std).view(-1, 1, 1) + torch.tensor(mean).view(-1, 1, 1)
+        pil_imgs = [transforms.ToPILImage()(img) for img in imgs]
         aug_imgs = []
-        if "cifar" in C.get()["dataset"]:
-            mean, std = _CIFAR_MEAN, _CIFAR_STD
-        elif "svhn" in C.get()["dataset"]:
-            mean, std = _SVHN_MEAN, _SVHN_STD
-        # applied_policies = []
-        for gr_id, img in zip(gr_ids, data):
-            pil_img = transforms.ToPILImage()(UnNormalize()(img.cpu()))
-            _aug = Augmentation(policy[int(gr_id)])
-            aug_img = _aug(pil_img)
-            aug_img = self.transform(aug_img)
-            aug_imgs.append(aug_img)
-            # applied_policy = _aug.policy # Todo
-            # applied_policies.append(applied_policy)
-        aug_imgs = torch.stack(aug_imgs)
-        return aug_imgs.cuda()#, applied_policies
+        for gr_id in range(gr_num):
+            _aug = Augmentation(policy[gr_id])
+            aug_imgs.extend(self.transform(_aug(pil_img)) for pil_img in pil_imgs)
+        aug_imgs = stack_images(aug_imgs)
+        return aug_imgs.to(get_device())
 
     def train(self, policy, config):
         # gr: group별 optimal policy가 주어질 때 평균 reward가 가장 높도록 나누는 assigner
@@ -107,35 +244,44 @@ class GrSpliter(object):
         cv_id = config['cv_id']
         load_path = config["load_path"]
         max_step = config["max_step"]
-        childnet = get_model(C.get()['model'], num_class(C.get()['dataset'])).cuda()
-        ckpt = torch.load(load_path)
+        childnet = get_model(C.get()['model'], num_class(C.get()['dataset'])).to(get_device())
+        ckpt = load_checkpoint(load_path)
         if 'model' in ckpt:
             childnet.load_state_dict(ckpt['model'])
         else:
             childnet.load_state_dict(ckpt)
-        childnet = nn.DataParallel(childnet).cuda()
+        childnet = nn.DataParallel(childnet).to(get_device())
         childnet.eval()
         pol_losses = []
         ori_aug = C.get()["aug"]
         C.get()["aug"] = "clean"
         _, _, dataloader, _ = get_dataloaders(C.get()['dataset'], C.get()['batch'], config['dataroot'], config['cv_ratio_test'], split_idx=cv_id, rand_val=True)
+        num_samples = len(dataloader.dataset)
+        if self.feature_cache is not None:
+            dataloader = DataLoader(IndexedDataset(dataloader.dataset), batch_size=dataloader.batch_size, sampler=dataloader.sampler,
+                                    num_workers=dataloader.num_workers, collate_fn=dataloader.collate_fn, pin_memory=dataloader.pin_memory, drop_last=True)
         loader_iter = iter(dataloader)
         reports = []
         for step in range(max_step):
             try:
-                data, label = next(loader_iter)
-            except:
+                batch = next(loader_iter)
+            except StopIteration:
                 loader_iter = iter(dataloader)
-                data, label = next(loader_iter)
-            data = data.cuda()
-            label = label.cuda()
-            logits = self.model(data, label)
+                batch = next(loader_iter)
+            if self.feature_cache is not None:
+                data, label, index = batch
+                feature = self.feature_cache.lookup(num_samples, index, data, label)
+                logits = self.model.module.head(feature, label)
+            else:
+                data, label = batch
+                logits = self.model(data, label)
+            label = label.to(get_device())
             if self.mode=="supervised":
                 with torch.no_grad():
-                    losses = torch.zeros(gr_num, data.size(0)).cuda()
-                    for i in range(gr_num):
-                        aug_data = self.augmentation(data, i*torch.ones(data.size(0)), policy)
-                        losses[i] = self.loss_fn(childnet(aug_data), label)
+                    aug_data = self.augmentation(data, policy, gr_num)
+                    with autocast():
+                        aug_preds = childnet(aug_data).float()
+                    losses = self.loss_fn(aug_preds, label.repeat(gr_num)).view(gr_num, -1)
                     optimal_gr_ids = losses.min(0)[1]
                 loss = self.loss_fn(logits, optimal_gr_ids).mean()
                 loss.backward()
@@ -147,14 +293,14 @@ class GrSpliter(object):
                 log_probs = m.log_prob(gr_ids)
                 entropys = m.entropy()
                 with torch.no_grad():
-                    probs = m.log_prob(torch.tensor([[i] for i in range(gr_num)]).cuda()).exp()
-                    rewards_list = torch.zeros(gr_num, data.size(0)).cuda()
-                    for i in range(gr_num):
-                        aug_data = self.augmentation(data, i*torch.ones_like(gr_ids), policy)
-                        rewards_list[i] = 1. / (self.loss_fn(childnet(aug_data), label) + self.eps)
-                    rewards = torch.tensor([ rewards_list[gr_id][idx] for idx, gr_id in enumerate(gr_ids)]).cuda().detach()
+                    probs = m.probs.t()
+                    aug_data = self.augmentation(data, policy, gr_num)
+                    with autocast():
+                        aug_preds = childnet(aug_data).float()
+                    rewards_list = 1. / (self.loss_fn(aug_preds, label.repeat(gr_num)).view(gr_num, -1) + self.eps)
+                    rewards = rewards_list.gather(0, gr_ids.view(1, -1)).squeeze(0)
                     # value function as baseline
-                    baselines = sum([ prob*reward for prob, reward in zip(probs, rewards_list) ])
+                    baselines = (probs * rewards_list).sum(0)
                     advantages = rewards - baselines
                 if self.mode=="reinforce":
                     loss = ( -log_probs * advantages ).mean()
@@ -180,6 +326,8 @@ class GrSpliter(object):
                     entropy = (self.ent_w * entropys.mean()).cpu().detach().data
                 print(f"[step{step}/{max_step}] objective {np.mean(reports):.4f}, entropy {entropy:.4f}")
         C.get()["aug"] = ori_aug
+        if self.feature_cache is not None:
+            self.feature_cache.flush()
         return reports
 
 
@@ -23,9 +23,10 @@ lib_dir = (Path("__file__").parent).resolve()
 if str(lib_dir) not in sys.path: sys.path.insert(0, str(lib_dir))
 from FastAutoAugment.archive import remove_deplicates, policy_decoder, fa_reduced_svhn, fa_reduced_cifar10
 from FastAutoAugment.augmentations import augment_list
-from FastAutoAugment.common import get_logger, add_filehandler
+from FastAutoAugment.common import get_logger, add_filehandler, read_progress, load_checkpoint, autocast, get_device, device_count, ray_resources, trial_resources, max_concurrent_trials
 from FastAutoAugment.data import get_dataloaders, get_gr_dist, get_post_dataloader
 from FastAutoAugment.metrics import Accumulator, accuracy
+from FastAutoAugment.inference import load_eval_model
 from FastAutoAugment.networks import get_model, num_class
 from FastAutoAugment.train import train_and_eval
 from theconf import Config as C, ConfigArgumentParser
@@ -100,20 +101,15 @@ def get_affinity(aug, aff_bases, config, augment):
     aug_accs = []
     for cv_id, loader in enumerate(aug_loaders):
         # eval
-        model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-        ckpt = torch.load(load_paths[cv_id])
-        if 'model' in ckpt:
-            model.load_state_dict(ckpt['model'])
-        else:
-            model.load_state_dict(ckpt)
-        model.eval()
+        model = load_eval_model(load_paths[cv_id])
 
         metrics = Accumulator()
         for data, label in loader:
-            data = data.cuda()
-            label = label.cuda()
+            data = data.to(get_device())
+            label = label.to(get_device())
 
-            pred = model(data)
+            with autocast():
+                pred = model(data).float()
             loss = loss_fn(pred, label) # (N)
 
             _, pred = pred.topk(1, 1, True, True)
@@ -161,13 +157,7 @@ def eval_tta(config, augment, reporter):
     C.get()['aug'] = policy_decoder(augment, augment['num_policy'], augment['num_op'])
 
     # eval
-    model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-    ckpt = torch.load(save_path)
-    if 'model' in ckpt:
-        model.load_state_dict(ckpt['model'])
-    else:
-        model.load_state_dict(ckpt)
-    model.eval()
+    model = load_eval_model(save_path)
 
     loaders = []
     for _ in range(augment['num_policy']):  # TODO
@@ -183,10 +173,11 @@ def eval_tta(config, augment, reporter):
             corrects = []
             for loader in loaders:
                 data, label = next(loader)
-                data = data.cuda()
-                label = label.cuda()
+                data = data.to(get_device())
+                label = label.to(get_device())
 
-                pred = model(data)
+                with autocast():
+                    pred = model(data).float()
 
                 loss = loss_fn(pred, label)
                 losses.append(loss.detach().cpu().numpy().reshape(1,-1)) # (1,N)
@@ -213,7 +204,7 @@ def eval_tta(config, augment, reporter):
 
     del model
     metrics = metrics / 'cnt'
-    gpu_secs = (time.time() - start_t) * torch.cuda.device_count()
+    gpu_secs = (time.time() - start_t) * device_count()
     reporter(loss=metrics['loss'], top1_valid=metrics['correct'], elapsed_time=gpu_secs, done=True)
     return metrics['correct']
 
@@ -228,14 +219,7 @@ def eval_tta3(config, augment, reporter):
     C.get()['aug'] = policy_decoder(augment, augment['num_policy'], augment['num_op'])
 
     # eval
-    model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-    ckpt = torch.load(save_path)
-    if 'model' in ckpt:
-        model.load_state_dict(ckpt['model'])
-    else:
-        model.load_state_dict(ckpt)
-    del ckpt
-    model.eval()
+    model = load_eval_model(save_path)
 
     loader = get_post_dataloader(C.get()["dataset"], C.get()['batch'], augment["dataroot"], augment['cv_ratio_test'], cv_id, gr_id, gr_ids)
 
@@ -243,10 +227,11 @@ def eval_tta3(config, augment, reporter):
     metrics = Accumulator()
     loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
     for data, label in loader:
-        data = data.cuda()
-        label = label.cuda()
+        data = data.to(get_device())
+        label = label.to(get_device())
 
-        pred = model(data)
+        with autocast():
+            pred = model(data).float()
         loss = loss_fn(pred, label) # (N)
 
         _, pred = pred.topk(1, 1, True, True)
@@ -261,7 +246,7 @@ def eval_tta3(config, augment, reporter):
         del loss, correct, pred, data, label
     del model, loader
     metrics = metrics / 'cnt'
-    gpu_secs = (time.time() - start_t) * torch.cuda.device_count()
+    gpu_secs = (time.time() - start_t) * device_count()
     reporter(loss=metrics['loss'], top1_valid=metrics['correct'], elapsed_time=gpu_secs, done=True)
     return metrics['correct']
 
@@ -297,6 +282,7 @@ if __name__ == '__main__':
     parser.add_argument('--max_aug', type=int, default=100)
     parser.add_argument('--load_search', type=str)
     parser.add_argument('--rand_search', action='store_true')
+    parser.add_argument('--no-feature-cache', action='store_true', help='run the frozen backbone of the group assigner on every step')
 
     args = parser.parse_args()
     torch.backends.cudnn.benchmark = True
@@ -311,6 +297,7 @@ if __name__ == '__main__':
     logger.info(json.dumps(C.get().conf, sort_keys=True, indent=4))
     logger.info('initialize ray...')
     ray.init(address=args.redis)
+    train_remote = train_model.options(**ray_resources(0.5))   # cpus instead of gpus on cpu-only clusters
 
     num_result_per_cv = args.rpc
     gr_num = args.gr_num
@@ -327,7 +314,7 @@ if __name__ == '__main__':
     paths = [_get_path(C.get()['dataset'], C.get()['model']['type'], '%s_ratio%.1f_fold%d' % (args.childaug, args.cv_ratio, i)) for i in range(cv_num)]
     print(paths)
     reqs = [
-        train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, args.childaug, args.cv_ratio, i, save_path=paths[i], evaluation_interval=50)
+        train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, args.childaug, args.cv_ratio, i, save_path=paths[i], evaluation_interval=50)
         for i in range(cv_num)]
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
@@ -336,20 +323,15 @@ if __name__ == '__main__':
         while True:
             epochs_per_cv = OrderedDict()
             for cv_idx in range(cv_num):
-                try:
-                    latest_ckpt = torch.load(paths[cv_idx])
-                    if 'epoch' not in latest_ckpt:
-                        epochs_per_cv['cv%d' % (cv_idx + 1)] = C.get()['epoch']
-                        continue
-                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_ckpt['epoch']
-                except Exception as e:
-                    continue
+                latest_epoch = read_progress(paths[cv_idx])
+                if latest_epoch is not None:
+                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_epoch
             tqdm_epoch.set_postfix(epochs_per_cv)
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
@@ -364,7 +346,7 @@ if __name__ == '__main__':
     logger.info('processed in %.4f secs' % w.pause('train_no_aug'))
     if args.until == 1:
         sys.exit(0)
-    del latest_ckpt, pretrain_results, reqs
+    del pretrain_results, reqs
     if args.load_search is None:
         logger.info('----- Search Test-Time Augmentation Policies -----')
         w.start(tag='search-g_train')
@@ -381,13 +363,14 @@ if __name__ == '__main__':
         reward_attr = 'top1_valid'      # top1_valid or minus_loss
         # load childnet for g
         childnet = get_model(C.get()['model'], num_class(C.get()['dataset']))
-        ckpt = torch.load(paths[0])
+        ckpt = load_checkpoint(paths[0])
         if 'model' in ckpt:
             childnet.load_state_dict(ckpt['model'])
         else:
             childnet.load_state_dict(ckpt)
         # g definition
-        gr_spliter = GrSpliter(childnet, gr_num=args.gr_num, mode=args.mode)
+        feature_cache = None if args.no_feature_cache else feature_cache_path(base_path, paths[0])
+        gr_spliter = GrSpliter(childnet, gr_num=args.gr_num, mode=args.mode, feature_cache=feature_cache)
         del childnet, ckpt
         gr_results = []
         gr_dist_collector = defaultdict(list)
@@ -417,13 +400,13 @@ if __name__ == '__main__':
                         # print(best_configs[gr_id])
                         algo = HyperOptSearch(space, metric=reward_attr, mode="max")
                                             # points_to_evaluate=best_configs[gr_id])
-                        algo = ConcurrencyLimiter(algo, max_concurrent=13)
+                        algo = ConcurrencyLimiter(algo, max_concurrent=max_concurrent_trials(num_process_per_gpu))
                         experiment_spec = Experiment(
                             name,
                             run=name,
                             num_samples=args.num_search,# if r == args.repeat-1 else 25,
                             stop={'training_iteration': args.iter},
-                            resources_per_trial={'gpu': 1./num_process_per_gpu},
+                            resources_per_trial=trial_resources(1./num_process_per_gpu),
                             config={
                                 "dataroot": args.dataroot,
                                 'save_path': paths[cv_id], "cv_ratio_test": args.cv_ratio,
@@ -500,11 +483,11 @@ if __name__ == '__main__':
     w.start(tag='train_aug')
     torch.cuda.empty_cache()
     bench_policy_group = ori_aug
-    num_experiments = torch.cuda.device_count()
+    num_experiments = device_count()
     default_path = [_get_path(C.get()['test_dataset'], C.get()['model']['type'], 'ratio%.1f_default%d' % (args.cv_ratio, _), basemodel=False) for _ in range(num_experiments)]
     augment_path = [_get_path(C.get()['test_dataset'], C.get()['model']['type'], 'ratio%.1f_augment%d' % (args.cv_ratio, _), basemodel=False) for _ in range(num_experiments)]
-    reqs = [train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, bench_policy_group, 0.0, 0, save_path=default_path[_], evaluation_interval=5, gr_dist=gr_dist) for _ in range(num_experiments)] + \
-           [train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, final_policy_group, 0.0, 0, save_path=augment_path[_], evaluation_interval=5, gr_dist=gr_dist) for _ in range(num_experiments)]
+    reqs = [train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, bench_policy_group, 0.0, 0, save_path=default_path[_], evaluation_interval=5, gr_dist=gr_dist) for _ in range(num_experiments)] + \
+           [train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, final_policy_group, 0.0, 0, save_path=augment_path[_], evaluation_interval=5, gr_dist=gr_dist) for _ in range(num_experiments)]
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
     is_done = False
@@ -512,25 +495,19 @@ if __name__ == '__main__':
         while True:
             epochs = OrderedDict()
             for exp_idx in range(num_experiments):
-                try:
-                    if os.path.exists(default_path[exp_idx]):
-                        latest_ckpt = torch.load(default_path[exp_idx])
-                        epochs['default_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
-                except:
-                    pass
-                try:
-                    if os.path.exists(augment_path[exp_idx]):
-                        latest_ckpt = torch.load(augment_path[exp_idx])
-                        epochs['augment_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
-                except:
-                    pass
+                latest_epoch = read_progress(default_path[exp_idx])
+                if latest_epoch is not None:
+                    epochs['default_exp%d' % (exp_idx + 1)] = latest_epoch
+                latest_epoch = read_progress(augment_path[exp_idx])
+                if latest_epoch is not None:
+                    epochs['augment_exp%d' % (exp_idx + 1)] = latest_epoch
 
             tqdm_epoch.set_postfix(epochs)
             if len(epochs) == num_experiments*2 and min(epochs.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs) == num_experiments*2 and min(epochs.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
@@ -0,0 +1,228 @@
+import copy
+import fcntl
+import glob
+import hashlib
+import json
+import os
+
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from theconf import Config as C
+
+from FastAutoAugment.common import get_logger, load_checkpoint, get_device, memory_format, autocast
+from FastAutoAugment.networks import get_model, num_class
+from FastAutoAugment.networks.shakedrop import ShakeDrop
+
+logger = get_logger('Fast AutoAugment')
+
+
+def _set_module(model, name, module):
+    parent = model
+    names = name.split('.')
+    for n in names[:-1]:
+        parent = getattr(parent, n)
+    setattr(parent, names[-1], module)
+
+
+def _trace_folds(model, example):
+    """
+    runs example through model and pairs up modules whose output goes only into another module:
+    (conv, bn) for Conv2d -> BatchNorm, (bn, shake_drop) for BatchNorm -> ShakeDrop.
+    consumers are counted on the autograd graph, so functional uses (shortcuts, in-place adds, ...) are seen as well.
+    modules called more than once are never paired.
+    """
+    records, handles = [], []
+
+    def hook(module, input, output):
+        records.append((module, output.grad_fn))
+
+    named = dict((m, name) for name, m in model.named_modules() if isinstance(m, (nn.Conv2d, _BatchNorm, ShakeDrop)))
+    for m in named:
+        handles.append(m.register_forward_hook(hook))
+    try:
+        with torch.enable_grad():
+            output = model(example)
+    finally:
+        for h in handles:
+            h.remove()
+
+    consumers, visited, stack = {}, set(), [output.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in visited:
+            continue
+        visited.add(node)
+        for next_node, _ in node.next_functions:
+            if next_node is not None:
+                consumers[next_node] = consumers.get(next_node, 0) + 1
+                stack.append(next_node)
+
+    calls = {}
+    for m, _ in records:
+        calls[m] = calls.get(m, 0) + 1
+    producers = dict((node, m) for m, node in records if node is not None and calls[m] == 1 and consumers.get(node) == 1)
+
+    bn_folds, scale_folds = [], []
+    for m, node in records:
+        if node is None or calls[m] != 1:
+            continue
+        srcs = [producers[n] for n, _ in node.next_functions if n in producers]
+        if len(srcs) != 1:
+            continue
+        if isinstance(m, _BatchNorm) and isinstance(srcs[0], nn.Conv2d) and m.track_running_stats:
+            bn_folds.append((named[srcs[0]], named[m]))
+        elif isinstance(m, ShakeDrop) and isinstance(srcs[0], _BatchNorm) and srcs[0].affine:
+            scale_folds.append((named[srcs[0]], named[m]))
+    return bn_folds, scale_folds
+
+
+def fold_batchnorm(model, example, rtol=1e-3, atol=1e-4):
+    """
+    folds eval-mode BatchNorm layers into the Conv2d that feeds them, and ShakeDrop's eval scale (1 - p_drop)
+    into the BatchNorm that feeds it. folded layers are replaced by nn.Identity.
+    the folded model is checked against model on example; returns (folded model, number of folded layers),
+    or (model, 0) if the outputs differ.
+    """
+    assert not model.training
+    bn_folds, scale_folds = _trace_folds(model, example)
+    folded = copy.deepcopy(model)
+    modules = dict(folded.named_modules())
+
+    with torch.no_grad():
+        for bn_name, sd_name in scale_folds:
+            bn, scale = modules[bn_name], 1. - modules[sd_name].p_drop
+            bn.weight.mul_(scale)
+            bn.bias.mul_(scale)
+            _set_module(folded, sd_name, nn.Identity())
+
+        for conv_name, bn_name in bn_folds:
+            conv, bn = modules[conv_name], modules[bn_name]
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            if bn.weight is not None:
+                scale = scale * bn.weight
+            bias = -bn.running_mean * scale
+            if conv.bias is not None:
+                bias = bias + conv.bias * scale
+            if bn.bias is not None:
+                bias = bias + bn.bias
+            conv.weight.mul_(scale.view(-1, 1, 1, 1).to(conv.weight.dtype))
+            conv.bias = nn.Parameter(bias.to(conv.weight.dtype))
+            _set_module(folded, bn_name, nn.Identity())
+
+        expected, actual = model(example), folded(example)
+    if (actual - expected).abs().max() > atol + rtol * expected.abs().max():
+        logger.warning('batchnorm folding changed the outputs (max diff=%.6f), not folded.' % (actual - expected).abs().max().item())
+        return model, 0
+    return folded, len(bn_folds) + len(scale_folds)
+
+
+def export_model(model, example):
+    """ folds batchnorm and freezes model, traced on example (under autocast when `amp` is on), as a TorchScript module. """
+    model, num_folded = fold_batchnorm(model, example)
+    if hasattr(model, 'set_swish'):
+        model.set_swish(memory_efficient=False)     # autograd.Function can not be serialized
+    with torch.no_grad(), autocast():
+        exported = torch.jit.trace(model, example, check_trace=False)
+    if hasattr(torch.jit, 'freeze'):
+        exported = torch.jit.freeze(exported)
+    logger.info('model exported, %d layers folded.' % num_folded)
+    return exported
+
+
+def export_key(save_path, input_shape):
+    """
+    what an export of the checkpoint at save_path depends on: the checkpoint file, the input shape
+    and the device, amp, memory_format and eval_export settings.
+    """
+    stat = os.stat(save_path)
+    return json.dumps({
+        'checkpoint': [os.path.abspath(save_path), stat.st_size, stat.st_mtime_ns],
+        'input_shape': list(input_shape),
+        'device': get_device().type,
+        'amp': C.get().conf.get('amp', False),
+        'memory_format': str(memory_format()),
+        'eval_export': C.get().conf.get('eval_export', True),
+    }, sort_keys=True)
+
+
+def export_path(save_path, key):
+    return '%s.%s.export' % (save_path, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def prune_exports(save_path, keep):
+    # exports of save_path other than `keep` are stale (older checkpoint or settings); ones in use are left alone
+    for path in glob.glob(glob.escape(save_path) + '.*.export'):
+        if path == keep:
+            continue
+        with open(path + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            for p in (path, path + '.lock'):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+
+class EvalModel(object):
+    """
+    eval-mode model of the checkpoint at save_path, for search evaluators.
+    with `eval_export` (default) the model is exported (see `export_model`) on the first batch and the export is
+    cached next to the checkpoint, keyed by `export_key`. batches of another shape (e.g. the last one) and any export
+    failure use the eager model.
+    """
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.model = get_model(C.get()['model'], num_class(C.get()['dataset']))
+        ckpt = load_checkpoint(save_path)
+        if 'model' in ckpt:
+            self.model.load_state_dict(ckpt['model'])
+        else:
+            self.model.load_state_dict(ckpt)
+        del ckpt
+        self.model.eval()
+        self.exported = None if C.get().conf.get('eval_export', True) else False
+        self.input_shape = None
+
+    def _export(self, example):
+        key = export_key(self.save_path, example.shape)
+        path = export_path(self.save_path, key)
+        with open(path + '.lock', 'w') as lock:
+            # concurrent trials on the same checkpoint wait for the one exporting it, then load its export
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                extra_files = {'key': ''}
+                exported = torch.jit.load(path, map_location=get_device(), _extra_files=extra_files)
+                saved_key = extra_files['key']
+                if isinstance(saved_key, bytes):
+                    saved_key = saved_key.decode()
+                if saved_key == key:
+                    return exported
+
+            model = self.model.module if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)) else self.model
+            exported = export_model(copy.deepcopy(model), example)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            torch.jit.save(exported, tmp_path, _extra_files={'key': key})
+            os.replace(tmp_path, path)
+        prune_exports(self.save_path, path)
+        return exported
+
+    def __call__(self, data):
+        if self.exported is None:
+            try:
+                self.exported = self._export(data.contiguous(memory_format=memory_format()))
+                self.input_shape = data.shape
+            except Exception as e:
+                logger.warning('export failed, evaluating eager model. %s' % e)
+                self.exported = False
+        with torch.no_grad():
+            if self.exported is False or data.shape != self.input_shape:
+                return self.model(data)
+            return self.exported(data)
+
+
+def load_eval_model(save_path):
+    return EvalModel(save_path)
@@ -87,6 +87,50 @@ class Accumulator:
         return newone
 
 
+class TensorAccumulator(Accumulator):
+    """
+    Accumulator that keeps tensor values as running sums on their device.
+    they are brought to the host in a single transfer on `sync`, which reading the metrics does implicitly.
+    """
+    def __init__(self):
+        super(TensorAccumulator, self).__init__()
+        self.pending = {}
+
+    def add(self, key, value):
+        if not torch.is_tensor(value):
+            super(TensorAccumulator, self).add(key, value)
+        elif key in self.pending:
+            self.pending[key].add_(value.detach())
+        else:
+            self.pending[key] = value.detach().to(torch.float64, copy=True)
+
+    def sync(self):
+        if self.pending:
+            keys = list(self.pending.keys())
+            values = torch.stack([self.pending[key].reshape(()) for key in keys]).tolist()
+            for key, value in zip(keys, values):
+                self.metrics[key] += value
+            self.pending = {}
+        return self
+
+    def __getitem__(self, item):
+        return self.sync().metrics[item]
+
+    def get_dict(self):
+        self.sync()
+        return super(TensorAccumulator, self).get_dict()
+
+    def items(self):
+        return self.sync().metrics.items()
+
+    def __str__(self):
+        return str(dict(self.sync().metrics))
+
+    def __truediv__(self, other):
+        self.sync()
+        return super(TensorAccumulator, self).__truediv__(other)
+
+
 class SummaryWriterDummy:
     def __init__(self, log_dir):
         pass
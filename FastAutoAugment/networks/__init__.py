@@ -13,7 +13,9 @@ from FastAutoAugment.networks.shakeshake.shake_resnet import ShakeResNet
 from FastAutoAugment.networks.wideresnet import WideResNet
 from FastAutoAugment.networks.shakeshake.shake_resnext import ShakeResNeXt
 from FastAutoAugment.networks.efficientnet_pytorch import EfficientNet, RoutingFn
+from FastAutoAugment.networks.checkpoint import checkpoint_stages
 from FastAutoAugment.tf_port.tpu_bn import TpuBatchNormalization
+from FastAutoAugment.common import memory_format, get_device
 
 
 def get_model(conf, num_class=10, local_rank=-1):
@@ -78,12 +80,19 @@ def get_model(conf, num_class=10, local_rank=-1):
     else:
         raise NameError('no model named, %s' % name)
 
-    if local_rank >= 0:
+    if conf.get('checkpoint_segments', 0) > 0:
+        checkpoint_stages(model, conf['checkpoint_segments'])
+
+    model = model.to(memory_format=memory_format())
+    device = get_device()
+    if local_rank >= 0 and device.type == 'cuda':
         device = torch.device('cuda', local_rank)
         model = model.to(device)
         model = DistributedDataParallel(model, device_ids=[local_rank], output_device=local_rank)
+    elif local_rank >= 0:
+        model = DistributedDataParallel(model)
     else:
-        model = model.cuda()
+        model = model.to(device)
 #         model = DataParallel(model)
 
     cudnn.benchmark = True
@@ -0,0 +1,60 @@
+import inspect
+import math
+from collections import OrderedDict
+
+import torch
+from torch import nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+_checkpoint_kwargs = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+class CheckpointSequential(nn.Sequential):
+    """
+    nn.Sequential whose modules run as `segments` activation-checkpointed segments in training:
+    only segment inputs are kept, the rest is recomputed in backward.
+    rng state is replayed in the recomputation (ShakeDrop/ShakeShake draw the same alphas),
+    and batchnorm running statistics are not updated a second time.
+    state_dict keys are the ones of the wrapped nn.Sequential.
+    """
+    def __init__(self, sequential, segments):
+        super(CheckpointSequential, self).__init__(OrderedDict(sequential.named_children()))
+        self.segments = segments
+
+    def forward(self, input):
+        if not self.training or not torch.is_grad_enabled() or self.segments < 1:
+            return super(CheckpointSequential, self).forward(input)
+        modules = list(self)
+        size = int(math.ceil(len(modules) / float(self.segments)))
+        for start in range(0, len(modules), size):
+            input = checkpoint(self._run_segment(modules[start:start + size]), input, preserve_rng_state=True, **_checkpoint_kwargs)
+        return input
+
+    @staticmethod
+    def _run_segment(modules):
+        def run(x):
+            # the first pass of a (reentrant) checkpoint runs under no_grad, so grad mode marks the recomputation
+            bns = [m for module in modules for m in module.modules() if isinstance(m, _BatchNorm)] if torch.is_grad_enabled() else []
+            states = [(bn.momentum, bn.num_batches_tracked.clone() if bn.num_batches_tracked is not None else None) for bn in bns]
+            for bn in bns:
+                bn.momentum = 0.
+            try:
+                for module in modules:
+                    x = module(x)
+            finally:
+                for bn, (momentum, num_batches_tracked) in zip(bns, states):
+                    bn.momentum = momentum
+                    if num_batches_tracked is not None:
+                        bn.num_batches_tracked.copy_(num_batches_tracked)
+            return x
+        return run
+
+
+def checkpoint_stages(model, segments, stages=('layer1', 'layer2', 'layer3', 'layer4')):
+    """ wraps the residual stages of model (nn.Sequential attributes named in stages) into CheckpointSequential. """
+    for name in stages:
+        stage = getattr(model, name, None)
+        if isinstance(stage, nn.Sequential):
+            setattr(model, name, CheckpointSequential(stage, segments))
+    return model
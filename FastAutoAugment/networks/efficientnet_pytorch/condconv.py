@@ -37,16 +37,29 @@ def _calc_same_pad(i: int, k: int, s: int, d: int):
     return max((math.ceil(i / s) - 1) * s + (k - 1) * d + 1 - i, 0)
 
 
+def get_same_padding(input_size, kernel_size, stride, dilation):
+    """
+    splits TF 'SAME' padding for an input of input_size=(h, w) into the symmetric part, which the conv does itself,
+    and the extra bottom/right row/column to pad explicitly (None if the padding is symmetric).
+    """
+    pad_h = _calc_same_pad(input_size[0], kernel_size[0], stride[0], dilation[0])
+    pad_w = _calc_same_pad(input_size[1], kernel_size[1], stride[1], dilation[1])
+    extra = [0, pad_w % 2, 0, pad_h % 2]
+    return (pad_h // 2, pad_w // 2), extra if any(extra) else None
+
+
+def pad_same(x, extra):
+    memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+    return F.pad(x, extra).contiguous(memory_format=memory_format)
+
+
 def conv2d_same(
         x, weight: torch.Tensor, bias: Optional[torch.Tensor] = None, stride: Tuple[int, int] = (1, 1),
         padding: Tuple[int, int] = (0, 0), dilation: Tuple[int, int] = (1, 1), groups: int = 1):
-    ih, iw = x.size()[-2:]
-    kh, kw = weight.size()[-2:]
-    pad_h = _calc_same_pad(ih, kh, stride[0], dilation[0])
-    pad_w = _calc_same_pad(iw, kw, stride[1], dilation[1])
-    if pad_h > 0 or pad_w > 0:
-        x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
-    return F.conv2d(x, weight, bias, stride, (0, 0), dilation, groups)
+    padding, extra = get_same_padding(x.size()[-2:], weight.size()[-2:], stride, dilation)
+    if extra is not None:
+        x = pad_same(x, extra)
+    return F.conv2d(x, weight, bias, stride, padding, dilation, groups)
 
 
 def get_padding_value(padding, kernel_size, **kwargs):
@@ -110,6 +123,7 @@ class CondConv2d(nn.Module):
         self.dilation = _pair(dilation)
         self.groups = groups
         self.num_experts = num_experts
+        self.same_padding = {}   # input (h, w) -> get_same_padding(...), for dynamic_padding
 
         self.weight_shape = (self.out_channels, self.in_channels // self.groups) + self.kernel_size
         weight_num_param = 1
@@ -143,7 +157,6 @@ class CondConv2d(nn.Module):
             init_bias(self.bias)
 
     def forward(self, x, routing_weights):
-        x_orig = x
         B, C, H, W = x.shape
         weight = torch.matmul(routing_weights, self.weight)     # (Expert x out x in x 3x3) --> (B x out x in x 3x3)
         new_weight_shape = (B * self.out_channels, self.in_channels // self.groups) + self.kernel_size
@@ -152,48 +165,31 @@ class CondConv2d(nn.Module):
         if self.bias is not None:
             bias = torch.matmul(routing_weights, self.bias)
             bias = bias.view(B * self.out_channels)
-        # move batch elements with channels so each batch element can be efficiently convolved with separate kernel
-        x = x.view(1, B * C, H, W)
+
+        padding = self.padding
         if self.dynamic_padding:
-            out = conv2d_same(
-                x, weight, bias, stride=self.stride, padding=self.padding,
-                dilation=self.dilation, groups=self.groups * B)
+            if (H, W) not in self.same_padding:
+                self.same_padding[(H, W)] = get_same_padding((H, W), self.kernel_size, self.stride, self.dilation)
+            padding, extra = self.same_padding[(H, W)]
+            if extra is not None:
+                x = pad_same(x, extra)
+                H, W = x.shape[-2:]
+
+        # move batch elements with channels so each batch element can be efficiently convolved with separate kernel
+        channels_last = x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+        if channels_last:
+            # (B x H x W x C) --> (1 x H x W x B*C), viewed as a channels_last (1 x B*C x H x W)
+            x = x.permute(2, 3, 0, 1).reshape(1, H, W, B * C).permute(0, 3, 1, 2)
         else:
-            out = F.conv2d(
-                x, weight, bias, stride=self.stride, padding=self.padding,
-                dilation=self.dilation, groups=self.groups * B)
+            x = x.view(1, B * C, H, W)
+        out = F.conv2d(
+            x, weight, bias, stride=self.stride, padding=padding,
+            dilation=self.dilation, groups=self.groups * B)
 
         # out : (1 x B*out x ...)
-        out = out.permute([1, 0, 2, 3]).view(B, self.out_channels, out.shape[-2], out.shape[-1])
-
-        # out2 = self.forward_legacy(x_orig, routing_weights)
-        # lt = torch.lt(torch.abs(torch.add(out, -out2)), 1e-8)
-        # assert torch.all(lt), torch.abs(torch.add(out, -out2))[lt]
-        # print('checked')
-        return out
-
-    def forward_legacy(self, x, routing_weights):
-        # Literal port (from TF definition)
-        B, C, H, W = x.shape
-        weight = torch.matmul(routing_weights, self.weight)  # (Expert x out x in x 3x3) --> (B x out x in x 3x3)
-        x = torch.split(x, 1, 0)
-        weight = torch.split(weight, 1, 0)
-        if self.bias is not None:
-            bias = torch.matmul(routing_weights, self.bias)
-            bias = torch.split(bias, 1, 0)
-        else:
-            bias = [None] * B
-        out = []
-        if self.dynamic_padding:
-            conv_fn = conv2d_same
+        if channels_last:
+            out = out.permute(0, 2, 3, 1).reshape(out.shape[-2], out.shape[-1], B, self.out_channels)
+            out = out.permute(2, 3, 0, 1).contiguous(memory_format=torch.channels_last)
         else:
-            conv_fn = F.conv2d
-        for xi, wi, bi in zip(x, weight, bias):
-            wi = wi.view(*self.weight_shape)
-            if bi is not None:
-                bi = bi.view(*self.bias_shape)
-            out.append(conv_fn(
-                xi, wi, bi, stride=self.stride, padding=self.padding,
-                dilation=self.dilation, groups=self.groups))
-        out = torch.cat(out, 0)
+            out = out.permute([1, 0, 2, 3]).view(B, self.out_channels, out.shape[-2], out.shape[-1])
         return out
@@ -8,10 +8,12 @@ from .utils import (
     round_repeats,
     drop_connect,
     get_same_padding_conv2d,
+    calculate_output_image_size,
     get_model_params,
     efficientnet_params,
     load_pretrained_weights,
     MemoryEfficientSwish,
+    Swish,
 )
 
 
@@ -26,12 +28,13 @@ class MBConvBlock(nn.Module):
     Args:
         block_args (namedtuple): BlockArgs, see above
         global_params (namedtuple): GlobalParam, see above
+        image_size (int or list): input resolution of the block, None for dynamic padding
 
     Attributes:
         has_se (bool): Whether the block contains a Squeeze and Excitation layer.
     """
 
-    def __init__(self, block_args, global_params, norm_layer=None):
+    def __init__(self, block_args, global_params, norm_layer=None, image_size=None):
         super().__init__()
         self._block_args = block_args
         self._bn_mom = 1 - global_params.batch_norm_momentum
@@ -46,8 +49,8 @@ class MBConvBlock(nn.Module):
             self.routing_fn = RoutingFn(self._block_args.input_filters, self.condconv_num_expert)
 
         # Get static or dynamic convolution depending on image size
-        Conv2d = get_same_padding_conv2d(image_size=global_params.image_size, condconv_num_expert=block_args.condconv_num_expert)
-        Conv2dse = get_same_padding_conv2d(image_size=global_params.image_size)
+        Conv2d = get_same_padding_conv2d(image_size=image_size, condconv_num_expert=block_args.condconv_num_expert)
+        Conv2dse = get_same_padding_conv2d(image_size=[1, 1] if image_size is not None else None)
 
         # Expansion phase
         inp = self._block_args.input_filters  # number of input channels
@@ -62,6 +65,8 @@ class MBConvBlock(nn.Module):
         self._depthwise_conv = Conv2d(
             in_channels=oup, out_channels=oup, groups=oup,  # groups makes it depthwise
             kernel_size=k, stride=s, bias=False)
+        image_size = calculate_output_image_size(image_size, s)
+        Conv2d = get_same_padding_conv2d(image_size=image_size, condconv_num_expert=block_args.condconv_num_expert)
         self._bn1 = norm_layer(num_features=oup, momentum=self._bn_mom, eps=self._bn_eps)
 
         # Squeeze and Excitation layer, if desired
@@ -121,9 +126,9 @@ class MBConvBlock(nn.Module):
             x = x + inputs  # skip connection
         return x
 
-    def set_swish(self):
+    def set_swish(self, memory_efficient=True):
         """Sets swish function as memory efficient (for training) or standard (for export)"""
-        self._swish = MemoryEfficientSwish()
+        self._swish = MemoryEfficientSwish() if memory_efficient else Swish()
 
 
 class EfficientNet(nn.Module):
@@ -149,7 +154,8 @@ class EfficientNet(nn.Module):
             norm_layer = nn.BatchNorm2d
 
         # Get static or dynamic convolution depending on image size
-        Conv2d = get_same_padding_conv2d(image_size=global_params.image_size)
+        image_size = global_params.image_size
+        Conv2d = get_same_padding_conv2d(image_size=image_size)
 
         # Batch norm parameters
         bn_mom = 1 - self._global_params.batch_norm_momentum
@@ -160,6 +166,7 @@ class EfficientNet(nn.Module):
         out_channels = round_filters(32, self._global_params)  # number of output channels
         self._conv_stem = Conv2d(in_channels, out_channels, kernel_size=3, stride=2, bias=False)
         self._bn0 = norm_layer(num_features=out_channels, momentum=bn_mom, eps=bn_eps)
+        image_size = calculate_output_image_size(image_size, 2)
 
         # Build blocks
         self._blocks = nn.ModuleList([])
@@ -172,15 +179,17 @@ class EfficientNet(nn.Module):
             )
 
             # The first block needs to take care of stride and filter size increase.
-            self._blocks.append(MBConvBlock(block_args, self._global_params, norm_layer=norm_layer))
+            self._blocks.append(MBConvBlock(block_args, self._global_params, norm_layer=norm_layer, image_size=image_size))
+            image_size = calculate_output_image_size(image_size, block_args.stride)
             if block_args.num_repeat > 1:
                 block_args = block_args._replace(input_filters=block_args.output_filters, stride=1)
             for _ in range(block_args.num_repeat - 1):
-                self._blocks.append(MBConvBlock(block_args, self._global_params, norm_layer=norm_layer))
+                self._blocks.append(MBConvBlock(block_args, self._global_params, norm_layer=norm_layer, image_size=image_size))
 
         # Head
         in_channels = block_args.output_filters  # output of final block
         out_channels = round_filters(1280, self._global_params)
+        Conv2d = get_same_padding_conv2d(image_size=image_size)
         self._conv_head = Conv2d(in_channels, out_channels, kernel_size=1, bias=False)
         self._bn1 = norm_layer(num_features=out_channels, momentum=bn_mom, eps=bn_eps)
 
@@ -190,11 +199,11 @@ class EfficientNet(nn.Module):
         self._fc = nn.Linear(out_channels, self._global_params.num_classes)
         self._swish = MemoryEfficientSwish()
 
-    def set_swish(self):
+    def set_swish(self, memory_efficient=True):
         """Sets swish function as memory efficient (for training) or standard (for export)"""
-        self._swish = MemoryEfficientSwish()
+        self._swish = MemoryEfficientSwish() if memory_efficient else Swish()
         for block in self._blocks:
-            block.set_swish()
+            block.set_swish(memory_efficient)
 
     def extract_features(self, inputs):
         """ Returns output of the final convolution layer """
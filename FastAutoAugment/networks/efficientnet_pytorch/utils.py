@@ -18,7 +18,7 @@ from torch.utils import model_zoo
 
 
 # Parameters for the entire model (stem, all blocks, and head)
-from FastAutoAugment.networks.efficientnet_pytorch.condconv import CondConv2d
+from FastAutoAugment.networks.efficientnet_pytorch.condconv import CondConv2d, get_same_padding, pad_same
 
 GlobalParams = collections.namedtuple('GlobalParams', [
     'batch_norm_momentum', 'batch_norm_epsilon', 'dropout_rate',
@@ -54,6 +54,11 @@ class MemoryEfficientSwish(nn.Module):
         return SwishImplementation.apply(x)
 
 
+class Swish(nn.Module):
+    def forward(self, x):
+        return x * torch.sigmoid(x)
+
+
 def round_filters(filters, global_params):
     """ Calculate and round number of filters based on depth multiplier. """
     multiplier = global_params.width_coefficient
@@ -98,6 +103,15 @@ def drop_connect(inputs, drop_p, training):
     # return output
 
 
+def calculate_output_image_size(image_size, stride):
+    """ Output resolution of a 'SAME' padded conv with the given stride, None if image_size is unknown. """
+    if image_size is None:
+        return None
+    ih, iw = image_size if isinstance(image_size, (list, tuple)) else [image_size, image_size]
+    stride = stride if isinstance(stride, int) else stride[0]
+    return [int(math.ceil(ih / stride)), int(math.ceil(iw / stride))]
+
+
 def get_same_padding_conv2d(image_size=None, condconv_num_expert=1):
     """ Chooses static padding if you have specified an image size, and dynamic padding otherwise.
         Static padding is necessary for ONNX exporting of models. """
@@ -115,36 +129,32 @@ class Conv2dDynamicSamePadding(nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
         super().__init__(in_channels, out_channels, kernel_size, stride, 0, dilation, groups, bias)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
+        self.same_padding = {}  # input (h, w) -> (symmetric padding, extra bottom/right padding)
 
     def forward(self, x):
         ih, iw = x.size()[-2:]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            x = F.pad(x, [pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2])
-        return F.conv2d(x, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+        if (ih, iw) not in self.same_padding:
+            self.same_padding[(ih, iw)] = get_same_padding((ih, iw), self.weight.size()[-2:], self.stride, self.dilation)
+        padding, extra = self.same_padding[(ih, iw)]
+        if extra is not None:
+            x = pad_same(x, extra)
+        return F.conv2d(x, self.weight, self.bias, self.stride, padding, self.dilation, self.groups)
 
 
 class Conv2dStaticSamePadding(nn.Conv2d):
-    """ 2D Convolutions like TensorFlow, for a fixed image size"""
+    """ 2D Convolutions like TensorFlow, for a fixed input size (image_size is the input of this conv, not of the network)"""
 
     def __init__(self, in_channels, out_channels, kernel_size, image_size=None, **kwargs):
         super().__init__(in_channels, out_channels, kernel_size, **kwargs)
         self.stride = self.stride if len(self.stride) == 2 else [self.stride[0]] * 2
 
         # Calculate padding based on image size and save it
+        # the symmetric part is done by the conv itself, only an odd bottom/right remainder is padded explicitly
         assert image_size is not None
-        ih, iw = image_size if type(image_size) == list else [image_size, image_size]
-        kh, kw = self.weight.size()[-2:]
-        sh, sw = self.stride
-        oh, ow = math.ceil(ih / sh), math.ceil(iw / sw)
-        pad_h = max((oh - 1) * self.stride[0] + (kh - 1) * self.dilation[0] + 1 - ih, 0)
-        pad_w = max((ow - 1) * self.stride[1] + (kw - 1) * self.dilation[1] + 1 - iw, 0)
-        if pad_h > 0 or pad_w > 0:
-            self.static_padding = nn.ZeroPad2d((pad_w // 2, pad_w - pad_w // 2, pad_h // 2, pad_h - pad_h // 2))
+        ih, iw = image_size if isinstance(image_size, (list, tuple)) else [image_size, image_size]
+        self.padding, extra = get_same_padding((ih, iw), self.weight.size()[-2:], self.stride, self.dilation)
+        if extra is not None:
+            self.static_padding = nn.ZeroPad2d(tuple(extra))
         else:
             self.static_padding = Identity()
 
@@ -40,20 +40,15 @@ class BasicBlock(nn.Module):
 
         if self.downsample is not None:
             shortcut = self.downsample(x)
-            featuremap_size = shortcut.size()[2:4]
         else:
             shortcut = x
-            featuremap_size = out.size()[2:4]
 
-        batch_size = out.size()[0]
         residual_channel = out.size()[1]
         shortcut_channel = shortcut.size()[1]
 
         if residual_channel != shortcut_channel:
-            padding = torch.autograd.Variable(
-                torch.cuda.FloatTensor(batch_size, residual_channel - shortcut_channel, featuremap_size[0],
-                                       featuremap_size[1]).fill_(0))
-            out += torch.cat((shortcut, padding), 1)
+            # shortcut zero-padded to residual_channel; adding into the slice needs no padding tensor in any memory format
+            out[:, :shortcut_channel] += shortcut
         else:
             out += shortcut
 
@@ -97,20 +92,15 @@ class Bottleneck(nn.Module):
 
         if self.downsample is not None:
             shortcut = self.downsample(x)
-            featuremap_size = shortcut.size()[2:4]
         else:
             shortcut = x
-            featuremap_size = out.size()[2:4]
 
-        batch_size = out.size()[0]
         residual_channel = out.size()[1]
         shortcut_channel = shortcut.size()[1]
 
         if residual_channel != shortcut_channel:
-            padding = torch.autograd.Variable(
-                torch.cuda.FloatTensor(batch_size, residual_channel - shortcut_channel, featuremap_size[0],
-                                       featuremap_size[1]).fill_(0))
-            out += torch.cat((shortcut, padding), 1)
+            # shortcut zero-padded to residual_channel; adding into the slice needs no padding tensor in any memory format
+            out[:, :shortcut_channel] += shortcut
         else:
             out += shortcut
 
@@ -195,6 +185,7 @@ class PyramidNet(nn.Module):
                 m.bias.data.zero_()
 
         assert len(self.ps_shakedrop) == 0, self.ps_shakedrop
+        self.register_buffer('p_shakedrop', torch.tensor([m.p_drop for m in self.modules() if isinstance(m, ShakeDrop)]), persistent=False)
 
     def pyramidal_make_layer(self, block, block_depth, stride=1):
         downsample = None
@@ -214,6 +205,12 @@ class PyramidNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
+        if self.training:
+            # gates of all blocks in one kernel, rather than one sample (and host sync) per block
+            gates = torch.bernoulli(1 - self.p_shakedrop)
+            for shake_drop, gate in zip((m for m in self.modules() if isinstance(m, ShakeDrop)), gates.unbind(0)):
+                shake_drop.gate = gate.view(1)
+
         if self.dataset == 'cifar10' or self.dataset == 'cifar100':
             x = self.conv1(x)
             x = self.bn1(x)
@@ -3,35 +3,25 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 
 class ShakeDropFunction(torch.autograd.Function):
+    """
+    gate: 1-element tensor, 1 keeps the residual branch as is, 0 scales it by a random alpha (forward) / beta (backward).
+    both cases are computed as a blend, so the gate is never read on the host.
+    """
 
     @staticmethod
-    def forward(ctx, x, training=True, p_drop=0.5, alpha_range=[-1, 1]):
-        if training:
-            gate = torch.cuda.FloatTensor([0]).bernoulli_(1 - p_drop)
-            ctx.save_for_backward(gate)
-            if gate.item() == 0:
-                alpha = torch.cuda.FloatTensor(x.size(0)).uniform_(*alpha_range)
-                alpha = alpha.view(alpha.size(0), 1, 1, 1).expand_as(x)
-                return alpha * x
-            else:
-                return x
-        else:
-            return (1 - p_drop) * x
+    def forward(ctx, x, gate, alpha_range=[-1, 1]):
+        ctx.save_for_backward(gate)
+        alpha = x.new_empty(x.size(0), 1, 1, 1).uniform_(*alpha_range)
+        return x * (gate + (1 - gate) * alpha)
 
     @staticmethod
     def backward(ctx, grad_output):
         gate = ctx.saved_tensors[0]
-        if gate.item() == 0:
-            beta = torch.cuda.FloatTensor(grad_output.size(0)).uniform_(0, 1)
-            beta = beta.view(beta.size(0), 1, 1, 1).expand_as(grad_output)
-            beta = Variable(beta)
-            return beta * grad_output, None, None, None
-        else:
-            return grad_output, None, None, None
+        beta = grad_output.new_empty(grad_output.size(0), 1, 1, 1).uniform_(0, 1)
+        return grad_output * (gate + (1 - gate) * beta), None, None
 
 
 class ShakeDrop(nn.Module):
@@ -40,6 +30,12 @@ class ShakeDrop(nn.Module):
         super(ShakeDrop, self).__init__()
         self.p_drop = p_drop
         self.alpha_range = alpha_range
+        self.gate = None    # set by the network for every forward (and kept for checkpoint recomputation), see PyramidNet.forward
 
     def forward(self, x):
-        return ShakeDropFunction.apply(x, self.training, self.p_drop, self.alpha_range)
+        if not self.training:
+            return (1 - self.p_drop) * x
+        gate = self.gate
+        if gate is None:
+            gate = x.new_empty(1).bernoulli_(1 - self.p_drop)
+        return ShakeDropFunction.apply(x, gate.to(x.dtype), self.alpha_range)
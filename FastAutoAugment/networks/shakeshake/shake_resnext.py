@@ -5,7 +5,7 @@ import math
 import torch.nn as nn
 import torch.nn.functional as F
 
-from FastAutoAugment.networks.shakeshake.shakeshake import ShakeShake
+from FastAutoAugment.networks.shakeshake.shakeshake import shake_shake
 from FastAutoAugment.networks.shakeshake.shakeshake import Shortcut
 
 
@@ -22,7 +22,7 @@ class ShakeBottleNeck(nn.Module):
     def forward(self, x):
         h1 = self.branch1(x)
         h2 = self.branch2(x)
-        h = ShakeShake.apply(h1, h2, self.training)
+        h = shake_shake(h1, h2, self.training)
         h0 = x if self.equal_io else self.shortcut(x)
         return h + h0
 
@@ -3,27 +3,34 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 
 class ShakeShake(torch.autograd.Function):
+    """
+    per-sample alpha (forward) / beta (backward) of shape [batch, 1, 1, 1] are broadcast by the kernels,
+    nothing is kept for backward.
+    """
 
     @staticmethod
     def forward(ctx, x1, x2, training=True):
         if training:
-            alpha = torch.cuda.FloatTensor(x1.size(0)).uniform_()
-            alpha = alpha.view(alpha.size(0), 1, 1, 1).expand_as(x1)
+            alpha = x1.new_empty(x1.size(0), 1, 1, 1).uniform_()
         else:
             alpha = 0.5
-        return alpha * x1 + (1 - alpha) * x2
+        return torch.lerp(x2, x1, alpha)
 
     @staticmethod
     def backward(ctx, grad_output):
-        beta = torch.cuda.FloatTensor(grad_output.size(0)).uniform_()
-        beta = beta.view(beta.size(0), 1, 1, 1).expand_as(grad_output)
-        beta = Variable(beta)
+        beta = grad_output.new_empty(grad_output.size(0), 1, 1, 1).uniform_()
+        grad_x1 = beta * grad_output
+        return grad_x1, grad_output - grad_x1, None
 
-        return beta * grad_output, (1 - beta) * grad_output, None
+
+def shake_shake(x1, x2, training=True):
+    if not training:
+        # plain tensor op, so evaluation models can be traced / scripted
+        return torch.lerp(x2, x1, 0.5)
+    return ShakeShake.apply(x1, x2, training)
 
 
 class Shortcut(nn.Module):
@@ -36,6 +43,7 @@ class Shortcut(nn.Module):
         self.bn = nn.BatchNorm2d(out_ch)
 
     def forward(self, x):
+        memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
         h = F.relu(x)
 
         h1 = F.avg_pool2d(h, 1, self.stride)
@@ -44,5 +52,9 @@ class Shortcut(nn.Module):
         h2 = F.avg_pool2d(F.pad(h, (-1, 1, -1, 1)), 1, self.stride)
         h2 = self.conv2(h2)
 
-        h = torch.cat((h1, h2), 1)
+        # both halves are written into one output in the input's memory format, instead of a cat + contiguous copy
+        n, c, hh, ww = h1.size()
+        h = torch.empty((n, 2 * c, hh, ww), dtype=h1.dtype, device=h1.device, memory_format=memory_format)
+        h[:, :c].copy_(h1)
+        h[:, c:].copy_(h2)
         return self.bn(h)
@@ -0,0 +1,78 @@
+import copy
+import queue
+import threading
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import get_worker_info
+
+
+class PolicyServer(object):
+    """
+    serves controller policies to DataLoader workers.
+    a cpu copy of the controller runs in a thread of the training process, requests from all workers
+    that arrive together are answered with a single batched forward.
+    create clients (see `client`) before the DataLoader starts its workers.
+    """
+    def __init__(self, controller, num_workers, max_batch=1024, timeout=0.005):
+        self.controller = copy.deepcopy(controller).cpu().eval()
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.requests = mp.Queue()
+        self.responses = [mp.Queue() for _ in range(num_workers + 1)]  # slot 0: main process
+        self.thread = None
+
+    def client(self):
+        return PolicyClient(self.requests, self.responses)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _serve(self):
+        stopped = False
+        while not stopped:
+            request = self.requests.get()
+            if request is None:
+                break
+            requests, size = [request], len(request[1])
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=self.timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                requests.append(request)
+                size += len(request[1])
+
+            with torch.no_grad():
+                _, _, sampled_policies = self.controller(torch.cat([images for _, images in requests]))
+            offset = 0
+            for slot, images in requests:
+                self.responses[slot].put(sampled_policies[offset:offset + len(images)])
+                offset += len(images)
+
+
+class PolicyClient(object):
+    def __init__(self, requests, responses):
+        self.requests = requests
+        self.responses = responses
+
+    def __call__(self, images):
+        """
+        images: (tensor) [batch, 3, h, w]; [(image)->ToTensor->Normalize]
+        return sampled_policies: (np.array) [batch, n_subpolicy, n_op, 3]
+        """
+        worker_info = get_worker_info()
+        slot = 0 if worker_info is None else worker_info.id + 1
+        self.requests.put((slot, images))
+        return self.responses[slot].get()
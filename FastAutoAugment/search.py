@@ -1,10 +1,13 @@
 import copy
 import os
+import socket
 import sys
 import time
 from collections import OrderedDict, defaultdict
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 import numpy as np
 from hyperopt import hp
@@ -22,10 +25,10 @@ lib_dir = (Path("__file__").parent).resolve()
 if str(lib_dir) not in sys.path: sys.path.insert(0, str(lib_dir))
 from FastAutoAugment.archive import remove_deplicates, policy_decoder, fa_reduced_svhn, fa_reduced_cifar10
 from FastAutoAugment.augmentations import augment_list
-from FastAutoAugment.common import get_logger, add_filehandler
-from FastAutoAugment.data import get_dataloaders
+from FastAutoAugment.common import get_logger, add_filehandler, read_progress, autocast, get_device, device_count, ray_resources, trial_resources, max_concurrent_trials
+from FastAutoAugment.data import get_dataloaders, SubsetSampler
 from FastAutoAugment.metrics import Accumulator
-from FastAutoAugment.networks import get_model, num_class
+from FastAutoAugment.inference import load_eval_model
 from FastAutoAugment.train import train_and_eval
 from theconf import Config as C, ConfigArgumentParser
 import csv, random
@@ -101,36 +104,11 @@ def get_affinity(aug, aff_bases, config, augment):
         aug_loaders.append(validloader)
         del tl, tl2
 
-    loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
     aug_accs = []
     for cv_id, loader in enumerate(aug_loaders):
         # eval
-        model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-        ckpt = torch.load(load_paths[cv_id])
-        if 'model' in ckpt:
-            model.load_state_dict(ckpt['model'])
-        else:
-            model.load_state_dict(ckpt)
-        model.eval()
-
-        metrics = Accumulator()
-        for data, label in loader:
-            data = data.cuda()
-            label = label.cuda()
-
-            pred = model(data)
-            loss = loss_fn(pred, label) # (N)
-
-            _, pred = pred.topk(1, 1, True, True)
-            pred = pred.t()
-            correct = pred.eq(label.view(1, -1).expand_as(pred)).detach().cpu().numpy() # (1,N)
-
-            metrics.add_dict({
-                'minus_loss': -1 * np.sum(loss.detach().cpu().numpy()),
-                'correct': np.sum(correct),
-                'cnt': len(data)
-            })
-            del loss, correct, pred, data, label
+        model = load_eval_model(load_paths[cv_id])
+        metrics = _score_tta(model, [loader], Accumulator())
         aug_accs.append(metrics['correct'] / metrics['cnt'])
     del model
     affs = []
@@ -148,31 +126,12 @@ def train_model(config, dataloaders, dataroot, augment, cv_ratio_test, cv_fold,
     return C.get()['model']['type'], cv_fold, result
 
 
-def eval_tta(config, augment, reporter):
-    C.get()
-    C.get().conf = config
-    cv_ratio_test, cv_fold, save_path = augment['cv_ratio_test'], augment['cv_fold'], augment['save_path']
-
-    # setup - provided augmentation rules
-    C.get()['aug'] = policy_decoder(augment, augment['num_policy'], augment['num_op'])
-
-    # eval
-    model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-    ckpt = torch.load(save_path)
-    if 'model' in ckpt:
-        model.load_state_dict(ckpt['model'])
-    else:
-        model.load_state_dict(ckpt)
-    model.eval()
-
-    loaders = []
-    for _ in range(augment['num_policy']):  # TODO
-        _, tl, validloader, tl2 = get_dataloaders(C.get()['dataset'], C.get()['batch'], augment['dataroot'], cv_ratio_test, split_idx=cv_fold)
-        loaders.append(iter(validloader))
-        del tl, tl2
-
-    start_t = time.time()
-    metrics = Accumulator()
+def _score_tta(model, loaders, metrics):
+    """
+    loaders: one per augmentation policy, iterated in lockstep over the same samples.
+    accumulates the per-sample minimum loss (as minus_loss) and maximum correctness over loaders, and cnt, into metrics.
+    """
+    loaders = [iter(loader) for loader in loaders]
     loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
     try:
         while True:
@@ -180,10 +139,11 @@ def eval_tta(config, augment, reporter):
             corrects = []
             for loader in loaders:
                 data, label = next(loader)
-                data = data.cuda()
-                label = label.cuda()
+                data = data.to(get_device())
+                label = label.to(get_device())
 
-                pred = model(data)
+                with autocast():
+                    pred = model(data).float()
 
                 loss = loss_fn(pred, label)
                 losses.append(loss.detach().cpu().numpy().reshape(1,-1)) # (1,N)
@@ -207,10 +167,80 @@ def eval_tta(config, augment, reporter):
             del corrects, corrects_max
     except StopIteration:
         pass
+    return metrics
+
+
+def _shard_loader(loader, rank, world_size):
+    # every world_size-th sample of the (ordered) validation loader, starting at rank
+    return torch.utils.data.DataLoader(
+        loader.dataset, batch_size=loader.batch_size, sampler=SubsetSampler(list(loader.sampler.indices)[rank::world_size]),
+        num_workers=loader.num_workers, pin_memory=loader.pin_memory, drop_last=False, collate_fn=loader.collate_fn)
+
+
+def _eval_tta_shard(augment, rank=0, world_size=1):
+    cv_ratio_test, cv_fold, save_path = augment['cv_ratio_test'], augment['cv_fold'], augment['save_path']
+
+    # setup - provided augmentation rules
+    C.get()['aug'] = policy_decoder(augment, augment['num_policy'], augment['num_op'])
 
+    # eval
+    model = load_eval_model(save_path)
+
+    loaders = []
+    for _ in range(augment['num_policy']):  # TODO
+        _, tl, validloader, tl2 = get_dataloaders(C.get()['dataset'], C.get()['batch'], augment['dataroot'], cv_ratio_test, split_idx=cv_fold)
+        if world_size > 1:
+            validloader = _shard_loader(validloader, rank, world_size)
+        loaders.append(validloader)
+        del tl, tl2
+
+    start_t = time.time()
+    metrics = _score_tta(model, loaders, Accumulator())
     del model
+    return metrics, time.time() - start_t
+
+
+def _eval_tta_worker(rank, world_size, port, config, augment, queue):
+    C.get()
+    C.get().conf = config
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size)
+    metrics, elapsed = _eval_tta_shard(augment, rank, world_size)
+
+    sums = torch.tensor([metrics['minus_loss'], metrics['correct'], metrics['cnt']], dtype=torch.float64)
+    elapsed = torch.tensor([elapsed], dtype=torch.float64)
+    dist.all_reduce(sums, dist.ReduceOp.SUM)
+    dist.all_reduce(elapsed, dist.ReduceOp.MAX)
+    if rank == 0:
+        queue.put((sums.tolist(), elapsed.item()))
+    dist.destroy_process_group()
+
+
+def _eval_tta_distributed(config, augment, world_size):
+    """ _eval_tta_shard on world_size local processes, each scoring a slice of the validation set (gloo). """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    queue = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_eval_tta_worker, args=(world_size, port, config, augment, queue), nprocs=world_size)
+    (minus_loss, correct, cnt), elapsed = queue.get()
+
+    metrics = Accumulator()
+    metrics.add_dict({'minus_loss': minus_loss, 'correct': correct, 'cnt': cnt})
+    return metrics, elapsed
+
+
+def eval_tta(config, augment, reporter):
+    C.get()
+    C.get().conf = config
+    world_size = augment.get('eval_workers', 1)
+
+    if world_size > 1:
+        metrics, elapsed = _eval_tta_distributed(config, augment, world_size)
+    else:
+        metrics, elapsed = _eval_tta_shard(augment)
+
     metrics = metrics / 'cnt'
-    gpu_secs = (time.time() - start_t) * torch.cuda.device_count()
+    gpu_secs = elapsed * device_count() * world_size
     reporter(minus_loss=metrics['minus_loss'], top1_valid=metrics['correct'], elapsed_time=gpu_secs, done=True)
     return metrics['correct']
 
@@ -224,13 +254,7 @@ def eval_tta2(config, augment, reporter):
     C.get()['aug'] = policy_decoder(augment, augment['num_policy'], augment['num_op'])
 
     # eval
-    model = get_model(C.get()['model'], num_class(C.get()['dataset']))
-    ckpt = torch.load(save_path)
-    if 'model' in ckpt:
-        model.load_state_dict(ckpt['model'])
-    else:
-        model.load_state_dict(ckpt)
-    model.eval()
+    model = load_eval_model(save_path)
 
     loaders = []
     for i in range(num_repeat):
@@ -241,28 +265,11 @@ def eval_tta2(config, augment, reporter):
 
     start_t = time.time()
     metrics = Accumulator()
-    loss_fn = torch.nn.CrossEntropyLoss(reduction='none')
     for loader in loaders:
-        for data, label in loader:
-            data = data.cuda()
-            label = label.cuda()
-
-            pred = model(data)
-            loss = loss_fn(pred, label) # (N)
-
-            _, pred = pred.topk(1, 1, True, True)
-            pred = pred.t()
-            correct = pred.eq(label.view(1, -1).expand_as(pred)).detach().cpu().numpy() # (1,N)
-
-            metrics.add_dict({
-                'minus_loss': -1 * np.sum(loss.detach().cpu().numpy()),
-                'correct': np.sum(correct),
-                'cnt': len(data)
-            })
-            del loss, correct, pred, data, label
+        _score_tta(model, [loader], metrics)
     del model
     metrics = metrics / 'cnt'
-    gpu_secs = (time.time() - start_t) * torch.cuda.device_count()
+    gpu_secs = (time.time() - start_t) * device_count()
     reporter(minus_loss=metrics['minus_loss'], top1_valid=metrics['correct'], elapsed_time=gpu_secs, done=True)
     return metrics['correct']
 
@@ -290,6 +297,7 @@ if __name__ == '__main__':
     parser.add_argument('--repeat', type=int, default=1)
     parser.add_argument('--iter', type=int, default=5)
     parser.add_argument('--childaug', type=str, default="clean")
+    parser.add_argument('--eval-workers', type=int, default=1, help='local processes sharing the validation set of each search evaluation (gloo)')
 
     args = parser.parse_args()
     C.get()['exp_name'] = args.exp_name
@@ -303,6 +311,7 @@ if __name__ == '__main__':
     logger.info(json.dumps(C.get().conf, sort_keys=True, indent=4))
     logger.info('initialize ray...')
     ray.init(address=args.redis)
+    train_remote = train_model.options(**ray_resources(1))   # cpus instead of gpus on cpu-only clusters
 
     num_result_per_cv = args.rpc
     cv_num = args.cv_num
@@ -315,7 +324,7 @@ if __name__ == '__main__':
     paths = [_get_path(C.get()['dataset'], C.get()['model']['type'], '%s_ratio%.1f_fold%d' % (args.childaug, args.cv_ratio, i)) for i in range(cv_num)]
     print(paths)
     reqs = [
-        train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, args.childaug, args.cv_ratio, i, save_path=paths[i], skip_exist=True)
+        train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, args.childaug, args.cv_ratio, i, save_path=paths[i], skip_exist=True)
         for i in range(cv_num)]
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
@@ -324,20 +333,15 @@ if __name__ == '__main__':
         while True:
             epochs_per_cv = OrderedDict()
             for cv_idx in range(cv_num):
-                try:
-                    latest_ckpt = torch.load(paths[cv_idx])
-                    if 'epoch' not in latest_ckpt:
-                        epochs_per_cv['cv%d' % (cv_idx + 1)] = C.get()['epoch']
-                        continue
-                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_ckpt['epoch']
-                except Exception as e:
-                    continue
+                latest_epoch = read_progress(paths[cv_idx])
+                if latest_epoch is not None:
+                    epochs_per_cv['cv%d' % (cv_idx+1)] = latest_epoch
             tqdm_epoch.set_postfix(epochs_per_cv)
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs_per_cv) == cv_num and min(epochs_per_cv.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
@@ -365,6 +369,8 @@ if __name__ == '__main__':
             space['level_%d_%d' % (i, j)] = hp.uniform('level_%d_ %d' % (i, j), 0.0, 1.0)
 
     num_process_per_gpu = 1#2 if torch.cuda.device_count() == 8 else 3
+    eval_resources = trial_resources(1./num_process_per_gpu)
+    eval_resources['cpu'] *= args.eval_workers  # the workers of a sharded evaluation run on the trial's node
     final_policy_set = []
     total_computation = 0
     reward_attr = 'top1_valid'      # top1_valid or minus_loss
@@ -378,18 +384,19 @@ if __name__ == '__main__':
             # wr.writerow(result_to_save)
             register_trainable(name, lambda augs, reporter: eval_tta(copy.deepcopy(copied_c), augs, reporter))
             algo = HyperOptSearch(space, metric=reward_attr, mode="max")
-            algo = ConcurrencyLimiter(algo, max_concurrent=num_process_per_gpu * torch.cuda.device_count())
+            algo = ConcurrencyLimiter(algo, max_concurrent=max_concurrent_trials(num_process_per_gpu))
 
             experiment_spec = Experiment(
                 name,
                 run=name,
                 num_samples=args.num_search,# if r == args.repeat-1 else 25,
-                resources_per_trial={'gpu': 1./num_process_per_gpu},
+                resources_per_trial=eval_resources,
                 stop={'training_iteration': args.iter},
                 config={
                         'dataroot': args.dataroot, 'save_path': paths[cv_fold],
                         'cv_ratio_test': args.cv_ratio, 'cv_fold': cv_fold,
-                        'num_op': args.num_op, 'num_policy': args.num_policy
+                        'num_op': args.num_op, 'num_policy': args.num_policy,
+                        'eval_workers': args.eval_workers
                     },
                 local_dir=os.path.join(base_path, "ray_results"),
                 )
@@ -419,12 +426,12 @@ if __name__ == '__main__':
     logger.info('----- Train with Augmentations model=%s dataset=%s aug=%s ratio(test)=%.1f -----' % (C.get()['model']['type'], C.get()['dataset'], C.get()['aug'], args.cv_ratio))
     w.start(tag='train_aug')
 
-    num_experiments = torch.cuda.device_count()
+    num_experiments = device_count()
     bench_policy_set = C.get()['aug']
     default_path = [_get_path(C.get()['dataset'], C.get()['model']['type'], 'ratio%.1f_default%d' % (args.cv_ratio, _), basemodel=False) for _ in range(num_experiments)]
     augment_path = [_get_path(C.get()['dataset'], C.get()['model']['type'], 'ratio%.1f_augment%d' % (args.cv_ratio, _), basemodel=False) for _ in range(num_experiments)]
-    reqs = [train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, bench_policy_set, 0.0, 0, save_path=default_path[_], skip_exist=True) for _ in range(num_experiments)] + \
-        [train_model.remote(copy.deepcopy(copied_c), None, args.dataroot, final_policy_set, 0.0, 0, save_path=augment_path[_]) for _ in range(num_experiments)]
+    reqs = [train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, bench_policy_set, 0.0, 0, save_path=default_path[_], skip_exist=True) for _ in range(num_experiments)] + \
+        [train_remote.remote(copy.deepcopy(copied_c), None, args.dataroot, final_policy_set, 0.0, 0, save_path=augment_path[_]) for _ in range(num_experiments)]
 
     tqdm_epoch = tqdm(range(C.get()['epoch']))
     is_done = False
@@ -432,25 +439,19 @@ if __name__ == '__main__':
         while True:
             epochs = OrderedDict()
             for exp_idx in range(num_experiments):
-                try:
-                    if os.path.exists(default_path[exp_idx]):
-                        latest_ckpt = torch.load(default_path[exp_idx])
-                        epochs['default_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
-                except:
-                    pass
-                try:
-                    if os.path.exists(augment_path[exp_idx]):
-                        latest_ckpt = torch.load(augment_path[exp_idx])
-                        epochs['augment_exp%d' % (exp_idx + 1)] = latest_ckpt['epoch']
-                except:
-                    pass
+                latest_epoch = read_progress(default_path[exp_idx])
+                if latest_epoch is not None:
+                    epochs['default_exp%d' % (exp_idx + 1)] = latest_epoch
+                latest_epoch = read_progress(augment_path[exp_idx])
+                if latest_epoch is not None:
+                    epochs['augment_exp%d' % (exp_idx + 1)] = latest_epoch
 
             tqdm_epoch.set_postfix(epochs)
             if len(epochs) == num_experiments*2 and min(epochs.values()) >= C.get()['epoch']:
                 is_done = True
             if len(epochs) == num_experiments*2 and min(epochs.values()) >= epoch:
                 break
-            time.sleep(10)
+            time.sleep(1)
         if is_done:
             break
 
@@ -25,9 +25,11 @@ class RMSpropTF(Optimizer):
         centered (bool, optional) : if ``True``, compute the centered RMSProp,
             the gradient is normalized by an estimation of its variance
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
+        foreach (bool, optional): update all parameters of a group with multi-tensor
+            (torch._foreach_*) kernels (default: True)
     """
 
-    def __init__(self, params, lr=1e-2, alpha=0.99, eps=1e-8, momentum=0, weight_decay=0.0):
+    def __init__(self, params, lr=1e-2, alpha=0.99, eps=1e-8, momentum=0, weight_decay=0.0, foreach=True):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -38,7 +40,7 @@ class RMSpropTF(Optimizer):
             raise ValueError("Invalid alpha value: {}".format(alpha))
         assert momentum > 0.0
 
-        defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, weight_decay=weight_decay)
+        defaults = dict(lr=lr, momentum=momentum, alpha=alpha, eps=eps, weight_decay=weight_decay, foreach=foreach)
         super(RMSpropTF, self).__init__(params, defaults)
         self.initialized = False
 
@@ -46,11 +48,13 @@ class RMSpropTF(Optimizer):
         super(RMSpropTF, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('momentum', 0)
+            group.setdefault('foreach', True)
 
     def load_state_dict(self, state_dict):
         super(RMSpropTF, self).load_state_dict(state_dict)
         self.initialized = True
 
+    @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
         We modified pytorch's RMSProp to be same as Tensorflow's
@@ -62,14 +66,15 @@ class RMSpropTF(Optimizer):
         """
         loss = None
         if closure is not None:
-            loss = closure()
+            with torch.enable_grad():
+                loss = closure()
 
         for group in self.param_groups:
+            params, grads, ms, mom = [], [], [], []
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError('RMSprop does not support sparse gradients')
                 state = self.state[p]
 
@@ -77,25 +82,55 @@ class RMSpropTF(Optimizer):
                 if len(state) == 0:
                     assert not self.initialized
                     state['step'] = 0
-                    state['ms'] = torch.ones_like(p.data)  #, memory_format=torch.preserve_format)
-                    state['mom'] = torch.zeros_like(p.data)  #, memory_format=torch.preserve_format)
+                    state['ms'] = torch.ones_like(p)  #, memory_format=torch.preserve_format)
+                    state['mom'] = torch.zeros_like(p)  #, memory_format=torch.preserve_format)
+                state['step'] += 1
 
-                # weight decay -----
-                if group['weight_decay'] > 0:
-                    grad = grad.add(group['weight_decay'], p.data)
+                params.append(p)
+                grads.append(p.grad)
+                ms.append(state['ms'])
+                mom.append(state['mom'])
+            if not params:
+                continue
 
-                rho = group['alpha']
-                ms = state['ms']
-                mom = state['mom']
-                state['step'] += 1
+            assert group['momentum'] > 0
+            if group['foreach']:
+                _multi_tensor_rmsprop_tf(params, grads, ms, mom, group)
+            else:
+                _single_tensor_rmsprop_tf(params, grads, ms, mom, group)
+
+        return loss
 
-                # ms.mul_(rho).addcmul_(1 - rho, grad, grad)
-                ms.add_(torch.mul(grad, grad).add_(-ms) * (1. - rho))
-                assert group['momentum'] > 0
 
-                # new rmsprop
-                mom.mul_(group['momentum']).addcdiv_(group['lr'], grad, (ms + group['eps']).sqrt())
+def _single_tensor_rmsprop_tf(params, grads, ms, mom, group):
+    rho = group['alpha']
+    for p, grad, ms_, mom_ in zip(params, grads, ms, mom):
+        # weight decay -----
+        if group['weight_decay'] > 0:
+            grad = grad.add(p, alpha=group['weight_decay'])
 
-                p.data.add_(-1.0, mom)
+        # ms.mul_(rho).addcmul_(1 - rho, grad, grad)
+        ms_.add_(torch.mul(grad, grad).sub_(ms_), alpha=1. - rho)
 
-        return loss
+        # new rmsprop
+        mom_.mul_(group['momentum']).addcdiv_(grad, (ms_ + group['eps']).sqrt(), value=group['lr'])
+
+        p.add_(mom_, alpha=-1.0)
+
+
+def _multi_tensor_rmsprop_tf(params, grads, ms, mom, group):
+    # same update as _single_tensor_rmsprop_tf, a few kernels per group instead of per parameter
+    rho = group['alpha']
+    if group['weight_decay'] > 0:
+        grads = torch._foreach_add(grads, params, alpha=group['weight_decay'])
+
+    sq = torch._foreach_mul(grads, grads)
+    torch._foreach_sub_(sq, ms)
+    torch._foreach_add_(ms, sq, alpha=1. - rho)
+
+    denom = torch._foreach_add(ms, group['eps'])
+    torch._foreach_sqrt_(denom)
+    torch._foreach_mul_(mom, group['momentum'])
+    torch._foreach_addcdiv_(mom, grads, denom, value=group['lr'])
+
+    torch._foreach_add_(params, mom, alpha=-1.0)
@@ -3,6 +3,7 @@ from torch.nn import BatchNorm2d
 from torch.nn.parameter import Parameter
 import torch.distributed as dist
 from torch import nn
+import torch.nn.functional as F
 
 
 class TpuBatchNormalization(nn.Module):
@@ -21,9 +22,20 @@ class TpuBatchNormalization(nn.Module):
         self.eps = eps
         self.momentum = momentum
 
-    def _reduce_avg(self, t):
-        dist.all_reduce(t, dist.ReduceOp.SUM)
-        t.mul_(1. / dist.get_world_size())
+    def _group_stats(self, input):
+        """
+        mean and variance over the batches of all processes.
+        mean and mean-of-square are packed into one buffer, so each layer does a single all_reduce
+        (none with a single process). only called when torch.distributed is initialized.
+        """
+        with torch.no_grad():
+            shard_var, shard_mean = torch.var_mean(input.float(), dim=(0, 2, 3), unbiased=False)
+            stats = torch.stack((shard_mean, shard_var + shard_mean * shard_mean))
+            if dist.get_world_size() > 1:
+                dist.all_reduce(stats, dist.ReduceOp.SUM)
+                stats.mul_(1. / dist.get_world_size())
+            group_mean, group_mean_of_square = stats
+            return group_mean, group_mean_of_square - group_mean * group_mean
 
     def forward(self, input):
         if not self.training or not dist.is_initialized():
@@ -32,27 +44,11 @@ class TpuBatchNormalization(nn.Module):
             # print(self.weight.shape, self.bias.shape)
             return bn.mul(self.weight.view(1, self.weight.shape[0], 1, 1)).add(self.bias.view(1, self.bias.shape[0], 1, 1))
 
-        shard_mean, shard_invstd = torch.batch_norm_stats(input, self.eps)
-        shard_vars = (1. / shard_invstd) ** 2 - self.eps
+        group_mean, group_vars = self._group_stats(input)
 
-        shard_square_of_mean = torch.mul(shard_mean, shard_mean)
-        shard_mean_of_square = shard_vars + shard_square_of_mean
-
-        group_mean = shard_mean.clone().detach()
-        self._reduce_avg(group_mean)
-        group_mean_of_square = shard_mean_of_square.clone().detach()
-        self._reduce_avg(group_mean_of_square)
-        group_vars = group_mean_of_square - torch.mul(group_mean, group_mean)
-
-        group_mean = group_mean.detach()
-        group_vars = group_vars.detach()
-
-        # print(self.running_mean.shape, self.running_var.shape)
-        self.running_mean.mul_(1. - self.momentum).add_(group_mean.mul(self.momentum))
-        self.running_var.mul_(1. - self.momentum).add_(group_vars.mul(self.momentum))
+        self.running_mean.mul_(1. - self.momentum).add_(group_mean, alpha=self.momentum)
+        self.running_var.mul_(1. - self.momentum).add_(group_vars, alpha=self.momentum)
         self.num_batches_tracked.add_(1)
 
-        # print(input.shape, group_mean.view(1, group_mean.shape[0], 1, 1).shape, group_vars.view(1, group_vars.shape[0], 1, 1).shape, self.eps)
-        bn = (input - group_mean.view(1, group_mean.shape[0], 1, 1)) / (torch.sqrt(group_vars.view(1, group_vars.shape[0], 1, 1) + self.eps))
-        # print(self.weight.shape, self.bias.shape)
-        return bn.mul(self.weight.view(1, self.weight.shape[0], 1, 1)).add(self.bias.view(1, self.bias.shape[0], 1, 1))
+        # statistics are constants for autograd, as before
+        return F.batch_norm(input, group_mean.to(input.dtype), group_vars.to(input.dtype), self.weight, self.bias, False, 0., self.eps)
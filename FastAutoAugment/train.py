@@ -3,6 +3,7 @@ import sys
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
 
+import inspect
 import itertools
 import json
 import logging
@@ -21,10 +22,10 @@ from torchvision import transforms
 from tqdm import tqdm
 from theconf import Config as C, ConfigArgumentParser
 
-from FastAutoAugment.common import get_logger, EMA, add_filehandler
-from FastAutoAugment.data import get_dataloaders, Augmentation, CutoutDefault
+from FastAutoAugment.common import get_logger, EMA, add_filehandler, write_progress, CheckpointWriter, load_checkpoint, autocast, grad_scaler, memory_format, get_device
+from FastAutoAugment.data import get_dataloaders, Augmentation, CutoutDefault, ToTensor, stack_images
 from FastAutoAugment.lr_scheduler import adjust_learning_rate_resnet
-from FastAutoAugment.metrics import accuracy, Accumulator, CrossEntropyLabelSmooth
+from FastAutoAugment.metrics import accuracy, TensorAccumulator, CrossEntropyLabelSmooth
 from FastAutoAugment.networks import get_model, num_class
 from FastAutoAugment.tf_port.rmsprop import RMSpropTF
 from FastAutoAugment.aug_mixup import CrossEntropyMixUpLabelSmooth, mixup
@@ -78,7 +79,7 @@ def gr_augment(imgs, gr_ids, gr_policies):
         transform = transforms.Compose([
             transforms.RandomCrop(32, padding=4),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            ToTensor(),
             transforms.Normalize(_CIFAR_MEAN, _CIFAR_STD),
         ])
         if C.get()['cutout'] > 0:
@@ -86,64 +87,162 @@ def gr_augment(imgs, gr_ids, gr_policies):
         aug_img = transform(aug_img)
         aug_imgs.append(aug_img)
         applied_policy.append(augment.policy)
-    aug_imgs = torch.stack(aug_imgs)
+    aug_imgs = stack_images(aug_imgs)
     assert type(aug_imgs) == torch.Tensor and aug_imgs.shape == imgs.shape, \
            "Augmented Image Type Error, type: {}, shape: {}".format(type(aug_imgs), aug_imgs.shape)
     return aug_imgs, applied_policy
 
-def run_epoch(model, loader, loss_fn, optimizer, desc_default='', epoch=0, writer=None, verbose=1, scheduler=None, is_master=True, ema=None, wd=0.0, tqdm_disabled=False):
+def split_decay_params(model):
+    """
+    returns (parameters to decay, batchnorm parameters)
+    """
+    decay, no_decay = [], []
+    for name, p in model.named_parameters():
+        if '_bn' in name or '.bn' in name:
+            no_decay.append(p)
+        else:
+            decay.append(p)
+    return decay, no_decay
+
+
+def get_optimizer(model):
+    """
+    optimizer.decay_mode='loss' adds the l2 penalty of the non-bn parameters to the loss in run_epoch,
+    'optimizer' has run_epoch add its gradient, wd * p, to the unscaled gradients with multi-tensor kernels before clipping
+    (param group key `grad_decay`; the optimizer's own weight_decay stays 0, it would only apply after clipping).
+    returns the optimizer and the parameters run_epoch should decay through the loss (None in 'optimizer' mode).
+    the two modes have different param_groups, each group records its decay_mode (see load_optimizer_state).
+    """
+    conf = C.get()['optimizer']
+    decay_params, no_decay_params = split_decay_params(model)
+    decay_mode = conf.get('decay_mode', 'loss')
+    if decay_mode == 'loss':
+        params = [{'params': list(model.parameters()), 'decay_mode': decay_mode}]
+        loss_decay_params = decay_params
+    elif decay_mode == 'optimizer':
+        params = [
+            {'params': decay_params, 'grad_decay': conf['decay'], 'decay_mode': decay_mode},
+            {'params': no_decay_params, 'grad_decay': 0.0, 'decay_mode': decay_mode},
+        ]
+        loss_decay_params = None
+    else:
+        raise ValueError('invalid decay_mode=%s' % decay_mode)
+
+    if conf['type'] == 'sgd':
+        kwargs = {'foreach': True} if 'foreach' in inspect.signature(optim.SGD).parameters else {}
+        optimizer = optim.SGD(
+            params,
+            lr=C.get()['lr'],
+            momentum=conf.get('momentum', 0.9),
+            weight_decay=0.0,
+            nesterov=conf.get('nesterov', True),
+            **kwargs
+        )
+    elif conf['type'] == 'rmsprop':
+        optimizer = RMSpropTF(
+            params,
+            lr=C.get()['lr'],
+            weight_decay=0.0,
+            alpha=0.9, momentum=0.9,
+            eps=0.001
+        )
+    else:
+        raise ValueError('invalid optimizer type=%s' % conf['type'])
+    return optimizer, loss_decay_params
+
+
+def load_optimizer_state(optimizer, state_dict):
+    """
+    optimizer.load_state_dict, failing clearly on a checkpoint saved with another optimizer.decay_mode
+    (checkpoints without it are 'loss' mode).
+    """
+    saved = sorted(set(g.get('decay_mode', 'loss') for g in state_dict['param_groups']))
+    current = sorted(set(g.get('decay_mode', 'loss') for g in optimizer.param_groups))
+    if saved != current:
+        raise ValueError('optimizer state saved with decay_mode=%s, can not be loaded with decay_mode=%s' % (','.join(saved), ','.join(current)))
+    optimizer.load_state_dict(state_dict)
+    for group in optimizer.param_groups:
+        if group.get('decay_mode') == 'optimizer' and 'grad_decay' not in group:
+            # saved when the decay was the optimizer's weight_decay
+            group['grad_decay'], group['weight_decay'] = group['weight_decay'], 0.0
+
+
+def run_epoch(model, loader, loss_fn, optimizer, desc_default='', epoch=0, writer=None, verbose=1, scheduler=None, is_master=True, ema=None, wd=0.0, tqdm_disabled=False, decay_params=None, scaler=None):
     if verbose:
         loader = tqdm(loader, disable=tqdm_disabled)
         loader.set_description('[%s %04d/%04d]' % (desc_default, epoch, C.get()['epoch']))
 
-    params_without_bn = [params for name, params in model.named_parameters() if not ('_bn' in name or '.bn' in name)]
+    if optimizer and wd > 0 and decay_params is None:
+        decay_params, _ = split_decay_params(model)
+    if optimizer and scaler is None:
+        scaler = grad_scaler()
+    grad_decay_groups = [g for g in optimizer.param_groups if g.get('grad_decay', 0.) > 0] if optimizer else []
 
     loss_ema = None
-    metrics = Accumulator()
+    metrics = TensorAccumulator()   # stays on the device between log_interval steps
+    log_interval = C.get().conf.get('log_interval', 20)
+    device = get_device()
+    data_format = memory_format()   # no-op when the loader already batches in this format
     cnt = 0
     total_steps = len(loader)
     steps = 0
     for data, label in loader:
         steps += 1
-        data, label = data.cuda(), label.cuda()
+        data, label = data.to(device).contiguous(memory_format=data_format), label.to(device)
 
         if C.get().conf.get('mixup', 0.0) <= 0.0 or optimizer is None:
-            preds = model(data)
+            with autocast():
+                preds = model(data).float()
             loss = loss_fn(preds, label)
         else:   # mixup
             data, targets, shuffled_targets, lam = mixup(data, label, C.get()['mixup'])
-            preds = model(data)
+            with autocast():
+                preds = model(data).float()
             loss = loss_fn(preds, targets, shuffled_targets, lam)
             del shuffled_targets, lam
 
         if optimizer:
-            loss += wd * (1. / 2.) * sum([torch.sum(p ** 2) for p in params_without_bn])
-            loss.backward()
+            if wd > 0:
+                loss += wd * (1. / 2.) * sum([torch.sum(p ** 2) for p in decay_params])
+            scaler.scale(loss).backward()
             grad_clip = C.get()['optimizer'].get('clip', 5.0)
+            if grad_clip > 0 or grad_decay_groups:
+                scaler.unscale_(optimizer)
+            if grad_decay_groups:
+                # decay_mode 'optimizer': gradient of the l2 penalty, added where backward would have added it in 'loss' mode
+                penalty = 0.
+                with torch.no_grad():
+                    for group in grad_decay_groups:
+                        params = [p for p in group['params'] if p.grad is not None]
+                        torch._foreach_add_([p.grad for p in params], params, alpha=group['grad_decay'])
+                        penalty += group['grad_decay'] * (1. / 2.) * torch.stack(torch._foreach_norm(params)).pow(2).sum()
+                loss = loss.detach() + penalty     # the logged loss includes the penalty, as in 'loss' mode
             if grad_clip > 0:
                 nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
 
             if ema is not None:
                 ema(model, (epoch - 1) * total_steps + steps)
 
         top1, top5 = accuracy(preds, label, (1, 5))
+        loss = loss.detach()
         metrics.add_dict({
-            'loss': loss.item() * len(data),
-            'top1': top1.item() * len(data),
-            'top5': top5.item() * len(data),
+            'loss': loss * len(data),
+            'top1': top1 * len(data),
+            'top5': top5 * len(data),
         })
         cnt += len(data)
-        if loss_ema:
-            loss_ema = loss_ema * 0.9 + loss.item() * 0.1
+        if loss_ema is not None:
+            loss_ema = loss_ema * 0.9 + loss * 0.1
         else:
-            loss_ema = loss.item()
-        if verbose:
+            loss_ema = loss
+        if verbose and (steps % log_interval == 0 or steps == total_steps):
             postfix = metrics / cnt
             if optimizer:
                 postfix['lr'] = optimizer.param_groups[0]['lr']
-            postfix['loss_ema'] = loss_ema
+            postfix['loss_ema'] = loss_ema.item()
             loader.set_postfix(postfix)
 
         if scheduler is not None:
@@ -181,10 +280,12 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
         else:
             gr_ids = None
         trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids)
+    device = get_device()
     if local_rank >= 0:
-        dist.init_process_group(backend='nccl', init_method='env://', world_size=int(os.environ['WORLD_SIZE']))
-        device = torch.device('cuda', local_rank)
-        torch.cuda.set_device(device)
+        dist.init_process_group(backend='nccl' if device.type == 'cuda' else 'gloo', init_method='env://', world_size=int(os.environ['WORLD_SIZE']))
+        if device.type == 'cuda':
+            device = torch.device('cuda', local_rank)
+            torch.cuda.set_device(device)
 
         C.get()['lr'] *= dist.get_world_size()
         logger.info(f'local batch={C.get()["batch"]} world_size={dist.get_world_size()} ----> total batch={C.get()["batch"] * dist.get_world_size()}')
@@ -207,24 +308,8 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
     criterion_ce = criterion = CrossEntropyLabelSmooth(num_class(dataset), C.get().conf.get('lb_smooth', 0))
     if C.get().conf.get('mixup', 0.0) > 0.0:
         criterion = CrossEntropyMixUpLabelSmooth(num_class(dataset), C.get().conf.get('lb_smooth', 0))
-    if C.get()['optimizer']['type'] == 'sgd':
-        optimizer = optim.SGD(
-            model.parameters(),
-            lr=C.get()['lr'],
-            momentum=C.get()['optimizer'].get('momentum', 0.9),
-            weight_decay=0.0,
-            nesterov=C.get()['optimizer'].get('nesterov', True)
-        )
-    elif C.get()['optimizer']['type'] == 'rmsprop':
-        optimizer = RMSpropTF(
-            model.parameters(),
-            lr=C.get()['lr'],
-            weight_decay=0.0,
-            alpha=0.9, momentum=0.9,
-            eps=0.001
-        )
-    else:
-        raise ValueError('invalid optimizer type=%s' % C.get()['optimizer']['type'])
+    optimizer, decay_params = get_optimizer(model)
+    scaler = grad_scaler()
 
     lr_scheduler_type = C.get()['lr_schedule'].get('type', 'cosine')
     if lr_scheduler_type == 'cosine':
@@ -253,7 +338,7 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
 
     if C.get()['optimizer']['ema'] > 0.0 and is_master:
         # https://discuss.pytorch.org/t/how-to-apply-exponential-moving-average-decay-for-variables/10856/4?u=ildoonet
-        ema = EMA(C.get()['optimizer']['ema'])
+        ema = EMA(C.get()['optimizer']['ema'], interval=C.get()['optimizer'].get('ema_step_interval', 1))
     else:
         ema = None
 
@@ -262,7 +347,7 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
     if save_path != 'test.pth':     # and is_master: --> should load all data(not able to be broadcasted)
         if save_path and os.path.exists(save_path):
             logger.info('%s file found. loading...' % save_path)
-            data = torch.load(save_path)
+            data = load_checkpoint(save_path)
             key = 'model' if 'model' in data else 'state_dict'
 
             if 'epoch' not in data:
@@ -274,7 +359,9 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
                 else:
                     model.load_state_dict({k if 'module.' in k else 'module.'+k: v for k, v in data[key].items()})
                 logger.info('optimizer.load_state_dict+')
-                optimizer.load_state_dict(data['optimizer'])
+                load_optimizer_state(optimizer, data['optimizer'])
+                if data.get('scaler'):
+                    scaler.load_state_dict(data['scaler'])
                 if data['epoch'] < C.get()['epoch']:
                     epoch_start = data['epoch']
                 else:
@@ -287,17 +374,22 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
             if only_eval:
                 logger.warning('model checkpoint not found. only-evaluation mode is off.')
             only_eval = False
+            if save_path and is_master:
+                write_progress(save_path, 0)
 
     if local_rank >= 0:
         for name, x in model.state_dict().items():
             dist.broadcast(x, 0)
         logger.info(f'multinode init. local_rank={dist.get_rank()} is_master={is_master}')
-        torch.cuda.synchronize()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
 
     tqdm_disabled = bool(os.environ.get('TASK_NAME', '')) and local_rank != 0  # KakaoBrain Environment
 
     if only_eval:
         logger.info('evaluation only+')
+        if save_path and is_master:
+            write_progress(save_path, max_epoch)
         model.eval()
         rs = dict()
         rs['train'] = run_epoch(model, trainloader, criterion, None, desc_default='train', epoch=0, writer=writers[0], is_master=is_master)
@@ -318,78 +410,84 @@ def train_and_eval(tag, dataloaders, dataroot, test_ratio=0.0, cv_fold=0, report
 
     # train loop
     best_top1 = 0
-    for epoch in range(epoch_start, max_epoch + 1):
-        if local_rank >= 0:
-            trainsampler.set_epoch(epoch)
+    with CheckpointWriter(compress=C.get().conf.get('save_compress', False)) as ckpt_writer:
+        for epoch in range(epoch_start, max_epoch + 1):
+            if local_rank >= 0:
+                trainsampler.set_epoch(epoch)
 
-        model.train()
-        rs = dict()
-        rs['train'] = run_epoch(model, trainloader, criterion, optimizer, desc_default='train', epoch=epoch, writer=writers[0], verbose=is_master, scheduler=scheduler, ema=ema, wd=C.get()['optimizer']['decay'], tqdm_disabled=tqdm_disabled)
-        model.eval()
+            model.train()
+            rs = dict()
+            rs['train'] = run_epoch(model, trainloader, criterion, optimizer, desc_default='train', epoch=epoch, writer=writers[0], verbose=is_master, scheduler=scheduler, ema=ema, wd=C.get()['optimizer']['decay'] if decay_params is not None else 0.0, tqdm_disabled=tqdm_disabled, decay_params=decay_params, scaler=scaler)
+            model.eval()
 
-        if math.isnan(rs['train']['loss']):
-            raise Exception('train loss is NaN.')
-
-        if ema is not None and C.get()['optimizer']['ema_interval'] > 0 and epoch % C.get()['optimizer']['ema_interval'] == 0:
-            logger.info(f'ema synced+ rank={dist.get_rank()}')
-            if ema is not None:
-                model.load_state_dict(ema.state_dict())
-            for name, x in model.state_dict().items():
-                # print(name)
-                dist.broadcast(x, 0)
-            torch.cuda.synchronize()
-            logger.info(f'ema synced- rank={dist.get_rank()}')
-
-        if is_master and (epoch % evaluation_interval == 0 or epoch == max_epoch):
-            with torch.no_grad():
-                rs['valid'] = run_epoch(model, validloader, criterion_ce, None, desc_default='valid', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
-                rs['test'] = run_epoch(model, testloader_, criterion_ce, None, desc_default='*test', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
+            if math.isnan(rs['train']['loss']):
+                raise Exception('train loss is NaN.')
 
+            if ema is not None and C.get()['optimizer']['ema_interval'] > 0 and epoch % C.get()['optimizer']['ema_interval'] == 0:
+                logger.info(f'ema synced+ rank={dist.get_rank()}')
                 if ema is not None:
-                    model_ema.load_state_dict({k.replace('module.', ''): v for k, v in ema.state_dict().items()})
-                    rs['valid'] = run_epoch(model_ema, validloader, criterion_ce, None, desc_default='valid(EMA)', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
-                    rs['test'] = run_epoch(model_ema, testloader_, criterion_ce, None, desc_default='*test(EMA)', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
-
-            logger.info(
-                f'epoch={epoch} '
-                f'[train] loss={rs["train"]["loss"]:.4f} top1={rs["train"]["top1"]:.4f} '
-                f'[valid] loss={rs["valid"]["loss"]:.4f} top1={rs["valid"]["top1"]:.4f} '
-                f'[test] loss={rs["test"]["loss"]:.4f} top1={rs["test"]["top1"]:.4f} '
-            )
-
-            if metric == 'last' or rs[metric]['top1'] > best_top1:
-                if metric != 'last':
-                    best_top1 = rs[metric]['top1']
-                for key, setname in itertools.product(['loss', 'top1', 'top5'], ['train', 'valid', 'test']):
-                    result['%s_%s' % (key, setname)] = rs[setname][key]
-                result['epoch'] = epoch
-
-                writers[1].add_scalar('valid_top1/best', rs['valid']['top1'], epoch)
-                writers[2].add_scalar('test_top1/best', rs['test']['top1'], epoch)
-
-                reporter(
-                    loss_valid=rs['valid']['loss'], top1_valid=rs['valid']['top1'],
-                    loss_test=rs['test']['loss'], top1_test=rs['test']['top1']
+                    model.load_state_dict(ema.state_dict())
+                for name, x in model.state_dict().items():
+                    # print(name)
+                    dist.broadcast(x, 0)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                logger.info(f'ema synced- rank={dist.get_rank()}')
+
+            if is_master and (epoch % evaluation_interval == 0 or epoch == max_epoch):
+                with torch.no_grad():
+                    rs['valid'] = run_epoch(model, validloader, criterion_ce, None, desc_default='valid', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
+                    rs['test'] = run_epoch(model, testloader_, criterion_ce, None, desc_default='*test', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
+
+                    if ema is not None:
+                        model_ema.load_state_dict({k.replace('module.', ''): v for k, v in ema.state_dict().items()})
+                        rs['valid'] = run_epoch(model_ema, validloader, criterion_ce, None, desc_default='valid(EMA)', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
+                        rs['test'] = run_epoch(model_ema, testloader_, criterion_ce, None, desc_default='*test(EMA)', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
+
+                logger.info(
+                    f'epoch={epoch} '
+                    f'[train] loss={rs["train"]["loss"]:.4f} top1={rs["train"]["top1"]:.4f} '
+                    f'[valid] loss={rs["valid"]["loss"]:.4f} top1={rs["valid"]["top1"]:.4f} '
+                    f'[test] loss={rs["test"]["loss"]:.4f} top1={rs["test"]["top1"]:.4f} '
                 )
 
-                # save checkpoint
-                if is_master and save_path and epoch_start != max_epoch:
-                    logger.info('save model@%d to %s, err=%.4f' % (epoch, save_path, 1 - best_top1))
-                    torch.save({
-                        'epoch': epoch,
-                        'log': {
-                            'train': rs['train'].get_dict(),
-                            'valid': rs['valid'].get_dict(),
-                            'test': rs['test'].get_dict(),
-                        },
-                        'optimizer': optimizer.state_dict(),
-                        'model': model.state_dict(),
-                        'ema': ema.state_dict() if ema is not None else None,
-                    }, save_path)
-
-        if gr_dist is not None:
-            gr_ids = m.sample().numpy()
-            trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids)
+                if metric == 'last' or rs[metric]['top1'] > best_top1:
+                    if metric != 'last':
+                        best_top1 = rs[metric]['top1']
+                    for key, setname in itertools.product(['loss', 'top1', 'top5'], ['train', 'valid', 'test']):
+                        result['%s_%s' % (key, setname)] = rs[setname][key]
+                    result['epoch'] = epoch
+
+                    writers[1].add_scalar('valid_top1/best', rs['valid']['top1'], epoch)
+                    writers[2].add_scalar('test_top1/best', rs['test']['top1'], epoch)
+
+                    reporter(
+                        loss_valid=rs['valid']['loss'], top1_valid=rs['valid']['top1'],
+                        loss_test=rs['test']['loss'], top1_test=rs['test']['top1']
+                    )
+
+                    # save checkpoint
+                    if is_master and save_path and epoch_start != max_epoch:
+                        logger.info('save model@%d to %s, err=%.4f' % (epoch, save_path, 1 - best_top1))
+                        ckpt_writer.save({
+                            'epoch': epoch,
+                            'log': {
+                                'train': rs['train'].get_dict(),
+                                'valid': rs['valid'].get_dict(),
+                                'test': rs['test'].get_dict(),
+                            },
+                            'optimizer': optimizer.state_dict(),
+                            'scaler': scaler.state_dict(),
+                            'model': model.state_dict(),
+                            'ema': ema.shadow if ema is not None else None,
+                        }, save_path)
+
+            if is_master and save_path:
+                ckpt_writer.submit(write_progress, save_path, epoch)    # after the checkpoint above is on disk
+
+            if gr_dist is not None:
+                gr_ids = m.sample().numpy()
+                trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0), gr_assign=gr_assign, gr_ids=gr_ids)
 
     del model
 
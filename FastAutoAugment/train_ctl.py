@@ -3,6 +3,7 @@ import sys
 
 sys.path.append(str(pathlib.Path(__file__).parent.parent.absolute()))
 
+import copy
 import itertools
 import json
 import logging
@@ -15,13 +16,14 @@ from torch import nn, optim
 from torch.nn.parallel.data_parallel import DataParallel
 from torch.nn.parallel import DistributedDataParallel
 import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, Subset
 from torchvision import transforms
 
 from tqdm import tqdm
 from theconf import Config as C, ConfigArgumentParser
 
-from FastAutoAugment.common import get_logger, EMA, add_filehandler
-from FastAutoAugment.data import get_dataloaders, Augmentation, get_custom_dataloaders, CutoutDefault
+from FastAutoAugment.common import get_logger, EMA, add_filehandler, write_progress, BackgroundGenerator, CheckpointWriter, load_checkpoint, grad_scaler, get_device
+from FastAutoAugment.data import get_dataloaders, get_normalization, Augmentation, CutoutDefault, ToTensor, stack_images
 from FastAutoAugment.lr_scheduler import adjust_learning_rate_resnet
 from FastAutoAugment.metrics import accuracy, Accumulator, CrossEntropyLabelSmooth
 from FastAutoAugment.networks import get_model, num_class
@@ -32,39 +34,63 @@ import random, numpy as np
 from FastAutoAugment.augmentations import get_augment, augment_list
 from torchvision.utils import save_image
 from FastAutoAugment.archive import fa_reduced_cifar10
+from FastAutoAugment.train import run_epoch, get_optimizer, load_optimizer_state
+from FastAutoAugment.policy_server import PolicyServer
+
+logger = get_logger('Fast AutoAugment')
+logger.setLevel(logging.INFO)
+
+_CIFAR_MEAN, _CIFAR_STD = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
 
 class AdapAugloader(object):
     """
     Wraper loader
+    prefetch > 0: batches are augmented by a background thread, up to `prefetch` batches ahead of the training step
+    dataset: name of the dataset of dataloader, for its normalization (default: `test_dataset` config)
     """
-    def __init__(self, dataloader, controller=None):
+    def __init__(self, dataloader, controller=None, prefetch=0, dataset=None):
         self.dataloader = dataloader
         self.controller = controller
+        self.prefetch = prefetch
+        self.dataset = dataset or C.get()['test_dataset']
+        self.loader_iter = None
         if self.controller:
             self.controller.eval()
 
     def __iter__(self):
-        self.loader_iter = iter(self.dataloader)
+        if isinstance(self.loader_iter, BackgroundGenerator):
+            self.loader_iter.close()
+        if self.prefetch > 0:
+            self.loader_iter = BackgroundGenerator(self.dataloader, self._augment, self.prefetch)
+        else:
+            self.loader_iter = map(self._augment, self.dataloader)
         return self
 
     def __next__(self):
-        inputs, labels = next(self.loader_iter)
+        aug_inputs, labels, applied_policy = next(self.loader_iter)
+        if applied_policy is not None:
+            self.applied_policy = applied_policy
+        return (aug_inputs, labels)
+
+    @torch.no_grad()
+    def _augment(self, batch):
+        inputs, labels = batch
+        applied_policy = None
         if self.controller:
             # ! original image to controller(only normalized)
             # ! augmented image to model
-            _, _, sampled_policies = self.controller(inputs.cuda())
-            batch_policies = batch_policy_decoder(sampled_policies) # (list:list:list:tuple) [batch, num_policy, n_op, 3]
-            aug_inputs, applied_policy = augment_data(inputs, batch_policies)
-            self.applied_policy = applied_policy
+            _, _, sampled_policies = self.controller(inputs.to(get_device()))
+            batch_policies = batch_policy_decoder(sampled_policies) # (structured np.array) [batch, num_policy, n_op]
+            aug_inputs, applied_policy = augment_data(inputs, batch_policies, self.dataset)
         else:
             aug_inputs = []
             for img in inputs:
-                pil_img = transforms.ToPILImage()(UnNormalize()(img.cpu()))
+                pil_img = transforms.ToPILImage()(UnNormalize(*get_normalization(self.dataset))(img.cpu()))
                 transform_img = transforms.Compose([
                     transforms.RandomCrop(32, padding=4),
                     transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                    transforms.Normalize(_CIFAR_MEAN, _CIFAR_STD),
+                    ToTensor(),
+                    transforms.Normalize(*get_normalization(self.dataset)),
                 ])
                 if C.get()['cutout'] > 0:
                     transform_img.transforms.append(CutoutDefault(C.get()['cutout']))
@@ -72,12 +98,140 @@ class AdapAugloader(object):
                     transform_img.transforms.insert(0, Augmentation(fa_reduced_cifar10())) ###
                 aug_img = transform_img(pil_img)
                 aug_inputs.append(aug_img)
-            aug_inputs = torch.stack(aug_inputs)
-        return (aug_inputs, labels)
+            aug_inputs = stack_images(aug_inputs)
+        return aug_inputs, labels, applied_policy
 
     def __len__(self):
         return len(self.dataloader)
 
+class ControllerCollate(object):
+    """
+    collate_fn for DataLoader workers: asks the policy server for the policies of the whole batch,
+    then augments the raw images in the worker.
+    transform: applied after the policies (see policy_transform), normalize: controller inputs (see controller_transform)
+    """
+    def __init__(self, policy_client, transform, normalize):
+        self.policy_client = policy_client
+        self.transform = transform
+        self.normalize = normalize
+
+    def __call__(self, batch):
+        imgs, labels = zip(*batch)
+        sampled_policies = self.policy_client(torch.stack([self.normalize(img) for img in imgs]))
+        batch_policies = batch_policy_decoder(sampled_policies)
+        aug_imgs = [self.transform(Augmentation(policy)(img)) for img, policy in zip(imgs, batch_policies)]
+        return stack_images(aug_imgs), torch.tensor(labels)
+
+
+class PolicyTableDataset(Dataset):
+    """
+    applies one of the precomputed controller policies of each sample (see build_policy_table) before `transform`
+    """
+    def __init__(self, dataset, policy_table, transform):
+        self.dataset = dataset          # returns untransformed PIL images
+        self.policy_table = policy_table  # (np.array, int8) [len(dataset), num_samples, n_subpolicy, n_op, 3]
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img, target = self.dataset[index]
+        sampled_policies = self.policy_table[index]
+        sample = random.randrange(len(sampled_policies)) if len(sampled_policies) > 1 else 0
+        policy = batch_policy_decoder(sampled_policies[sample][np.newaxis])[0]
+        img = Augmentation(policy)(img)
+        return self.transform(img), target
+
+
+@torch.no_grad()
+def build_policy_table(controller, dataset, dataname, path, batch, num_samples=1):
+    """
+    runs the controller once over `dataset` (images normalized as `dataname`) and stores `num_samples` sampled policies
+    per image as an int8 array [len(dataset), num_samples, n_subpolicy, n_op, 3] at `path`
+    """
+    controller.eval()
+    loader = DataLoader(_transform_view(dataset, controller_transform(dataname)), batch_size=batch, shuffle=False, num_workers=4, drop_last=False)
+    tmp_path = '%s.%d.tmp.npy' % (path, os.getpid())
+    table = None
+    offset = 0
+    for inputs, _ in tqdm(loader, desc='policy table'):
+        _, _, sampled_policies = controller(inputs.to(get_device()).repeat(num_samples, 1, 1, 1))
+        sampled_policies = sampled_policies.reshape((num_samples, len(inputs)) + sampled_policies.shape[1:]).swapaxes(0, 1)
+        if table is None:
+            table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.int8, shape=(len(dataset),) + sampled_policies.shape[1:])
+        table[offset:offset + len(inputs)] = sampled_policies
+        offset += len(inputs)
+    table.flush()
+    del table
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def _transform_view(dataset, transform):
+    # shallow copy of the dataset with another transform(None: untransformed PIL images)
+    view = copy.copy(dataset)
+    if isinstance(dataset, Subset):
+        view.dataset = _transform_view(dataset.dataset, transform)
+    else:
+        view.transform = transform
+    return view
+
+
+def _base_dataset(dataset):
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return dataset
+
+
+def _reload(dataloader, dataset, collate_fn=None):
+    # same sampling as `dataloader`, over `dataset`
+    return DataLoader(
+        dataset, batch_size=dataloader.batch_size, sampler=dataloader.sampler,
+        num_workers=dataloader.num_workers, pin_memory=dataloader.pin_memory, drop_last=dataloader.drop_last,
+        collate_fn=collate_fn or dataloader.collate_fn)
+
+
+def policy_server_loader(dataloader, policy_server, dataname):
+    """
+    same batches as `dataloader` (of dataset `dataname`), augmented in its workers with policies from `policy_server`
+    """
+    collate_fn = ControllerCollate(policy_server.client(), policy_transform(dataname), controller_transform(dataname))
+    return _reload(dataloader, _transform_view(dataloader.dataset, None), collate_fn=collate_fn)
+
+
+def policy_table_loader(dataloader, policy_table, dataname):
+    """
+    same batches as `dataloader` (of dataset `dataname`), augmented in its workers with policies precomputed by build_policy_table
+    """
+    dataset = PolicyTableDataset(_transform_view(dataloader.dataset, None), policy_table, policy_transform(dataname))
+    return _reload(dataloader, dataset)
+
+
+def controller_transform(dataset):
+    # controller inputs: [(image)->ToTensor->Normalize], normalized as `dataset`
+    return transforms.Compose([
+        ToTensor(),
+        transforms.Normalize(*get_normalization(dataset)),
+    ])
+
+
+def policy_transform(dataset):
+    """
+    transform applied to the images after the controller policies, the same for every policy_mode:
+    [(policy image)->RandomCrop->RandomHorizontalFlip->ToTensor->Normalize->CutOut], normalized as `dataset`
+    """
+    transform = transforms.Compose([
+        transforms.RandomCrop(32, padding=4),
+        transforms.RandomHorizontalFlip(),
+        ToTensor(),
+        transforms.Normalize(*get_normalization(dataset)),
+    ])
+    if C.get()['cutout'] > 0:
+        transform.transforms.append(CutoutDefault(C.get()['cutout']))
+    return transform
+
+
 class UnNormalize(object):
     def __init__(self, mean=_CIFAR_MEAN, std=_CIFAR_STD):
         self.mean = mean
@@ -111,31 +265,27 @@ def save_pic(inputs, aug_inputs, labels, policies, batch_policies, step, verbose
     save_image(inputs, save_path + "{}_ori.png".format(step))
     save_image(aug_inputs, save_path + "{}_aug.png".format(step))
 
-def augment_data(imgs, policys):
+def augment_data(imgs, policys, dataset):
     """
     arguments
-        imgs: (tensor) [batch, h, w, c]; [(image)->ToTensor->Normalize]
-        policys: (list:list:list:tuple) [batch, num_policy, n_op, 3]
+        imgs: (tensor) [batch, h, w, c]; [(image)->ToTensor->Normalize], normalized as `dataset`
+        policys: (structured np.array, see batch_policy_decoder) [batch, num_policy, n_op]
+        dataset: name of the dataset of imgs
     return
         aug_imgs: (tensor) [batch, h, w, c];
-        [(image)->(policys)->RandomResizedCrop->RandomHorizontalFlip->ToTensor->Normalize->CutOut]
+        [(image)->(policys)->policy_transform]
     """
     aug_imgs = []
     applied_policy = []
+    unnormalize = UnNormalize(*get_normalization(dataset))
+    transform_ctl = policy_transform(dataset)
     for img, policy in zip(imgs, policys):
-        # policy: (list:list:tuple) [num_policy, n_op, 3]
+        # policy: [num_policy, n_op] records of (name, prob, level)
         augment = Augmentation(policy)
-        pil_img = transforms.ToPILImage()(UnNormalize()(img.cpu()))
+        # rounded back to the uint8 pixels of the image, as the server and table policy_modes see them
+        pil_img = transforms.ToPILImage()(unnormalize(img.to('cpu', copy=True)).mul_(255).round_().byte())
         aug_img = augment(pil_img)
         # apply original training/valid transforms
-        transform_ctl = transforms.Compose([
-            transforms.RandomCrop(32, padding=4),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(_CIFAR_MEAN, _CIFAR_STD),
-        ])
-        if C.get()['cutout'] > 0:
-            transform_ctl.transforms.append(CutoutDefault(C.get()['cutout']))
         aug_img = transform_ctl(aug_img)
         aug_imgs.append(aug_img)
         applied_policy.append(augment.policy)
@@ -146,34 +296,38 @@ def augment_data(imgs, policys):
         # print(augment.policy)
         # save_image(img, "img.png")
         # save_image(aug_img, "aug_img.png")
-    aug_imgs = torch.stack(aug_imgs)
+    aug_imgs = stack_images(aug_imgs)
     assert type(aug_imgs) == torch.Tensor and aug_imgs.shape == imgs.shape, \
            "Augmented Image Type Error, type: {}, shape: {}".format(type(aug_imgs), aug_imgs.shape)
     return aug_imgs, applied_policy
 
+_OP_NAMES = np.array([op[0].__name__ for op in augment_list(False)])
+_POLICY_DTYPE = np.dtype([('name', _OP_NAMES.dtype), ('prob', np.float64), ('level', np.float64)])
+
 def batch_policy_decoder(augment): # augment: [batch, num_policy, n_op, 3]
-    op_list = augment_list(False)
-    batch_policies = []
-    for policy in augment:      # policy: [num_policy, n_op, 3]
-        policies = []
-        for subpolicies in policy: # subpolicies: [n_op, 3]
-            ops = []
-            for op in subpolicies:
-                op_idx, op_prob, op_level = op
-                op_prob = op_prob / 10.
-                op_level = op_level / 10.0 + 0.1
-                assert (0.0 <= op_prob <= 1.0) and (0.0 <= op_level <= 1.0), err_txt
-                ops.append((op_list[op_idx][0].__name__, op_prob, op_level))
-            policies.append(ops)
-        batch_policies.append(policies)
-    return batch_policies # (list:list:list:tuple) [batch, num_policy, n_op, 3]
+    """
+    decodes sampled (op, prob, level) ids by table lookup.
+    returns a structured array of (name, prob, level) records, [batch, num_policy, n_op];
+    each row can be used as a policy list directly, e.g. Augmentation(batch_policies[i]).
+    """
+    augment = np.asarray(augment)
+    batch_policies = np.empty(augment.shape[:-1], dtype=_POLICY_DTYPE)
+    batch_policies['name'] = _OP_NAMES[augment[..., 0]]
+    batch_policies['prob'] = augment[..., 1] / 10.
+    batch_policies['level'] = augment[..., 2] / 10. + 0.1
+    assert ((0.0 <= batch_policies['prob']) & (batch_policies['prob'] <= 1.0)).all() and \
+           ((0.0 <= batch_policies['level']) & (batch_policies['level'] <= 1.0)).all(), 'invalid prob/level ids'
+    return batch_policies # (structured np.array) [batch, num_policy, n_op]
 
 def train_controller(controller, dataloaders, save_path, ctl_save_path):
     dataset = C.get()['test_dataset']
-    ctl_train_steps = 1500
-    ctl_num_aggre = 10
-    ctl_entropy_w = 1e-5
-    ctl_ema_weight = 0.95
+    ctl_conf = C.get().conf.get('controller', {})
+    ctl_train_steps = ctl_conf.get('train_steps', 1500)
+    ctl_num_aggre = ctl_conf.get('num_aggre', 10)
+    ctl_batch_multiplier = ctl_conf.get('batch_multiplier', 1)   # loader batches concatenated per controller forward
+    ctl_entropy_w = ctl_conf.get('entropy_w', 1e-5)
+    ctl_ema_weight = ctl_conf.get('ema_weight', 0.95)
+    ctl_save_interval = ctl_conf.get('save_interval', 100)
     metrics = Accumulator()
     cnt = 0
 
@@ -182,17 +336,18 @@ def train_controller(controller, dataloaders, save_path, ctl_save_path):
     _, _, dataloader, _ = dataloaders # validloader
     optimizer = optim.SGD(
         controller.parameters(),
-        lr=0.00035,
+        lr=ctl_conf.get('lr', 0.00035),
         momentum=0.9,
         weight_decay=0.0,
         nesterov=True
     )
     # optimizer = optim.Adam(controller.parameters(), lr = 0.00035)
     # create a model & a criterion
+    device = get_device()
     model = get_model(C.get()['model'], num_class(dataset), local_rank=-1)
-    criterion = CrossEntropyLabelSmooth(num_class(dataset), C.get().conf.get('lb_smooth', 0), reduction="batched_sum").cuda()
+    criterion = CrossEntropyLabelSmooth(num_class(dataset), C.get().conf.get('lb_smooth', 0), reduction="batched_sum").to(device)
     # load model weights
-    data = torch.load(save_path)
+    data = load_checkpoint(save_path)
     key = 'model' if 'model' in data else 'state_dict'
 
     if 'epoch' not in data:
@@ -207,93 +362,95 @@ def train_controller(controller, dataloaders, save_path, ctl_save_path):
 
     model.eval()
     loader_iter = iter(dataloader) # [(image)->ToTensor->Normalize]
-    baseline = None
-    if os.path.isfile(ctl_save_path):
-        logger.info('------Controller load------')
-        checkpoint = torch.load(ctl_save_path)
-        controller.load_state_dict(checkpoint['ctl_state_dict'])
-        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
-        cnt = checkpoint['cnt']
-        mean_probs =  checkpoint['mean_probs']
-        accs =  checkpoint['accs']
-        metrics_dict = checkpoint['metrics']
-        metrics.metrics = metrics_dict
-        init_step = checkpoint['step']
-    else:
-        logger.info('------Train Controller from scratch------')
-        mean_probs = []
-        accs = []
-        init_step = 0
-    for step in tqdm(range(init_step+1, ctl_train_steps * ctl_num_aggre + 1)):
-        try:
-            inputs, labels = next(loader_iter)
-        except:
-            loader_iter = iter(dataloader)
-            inputs, labels = next(loader_iter)
-        batch_size = len(labels)
-        inputs, labels = inputs.cuda(), labels.cuda()
-        log_probs, entropys, sampled_policies = controller(inputs)
-        # evaluate model with augmented validation dataset
-        with torch.no_grad():
-            # compare Accuracy before/after augmentation
-            # ori_preds = model(inputs)
-            # ori_top1, ori_top5 = accuracy(ori_preds, labels, (1, 5))
-            batch_policies = batch_policy_decoder(sampled_policies) # (list:list:list:tuple) [batch, num_policy, n_op, 3]
-            aug_inputs, applied_policy = augment_data(inputs, batch_policies)
-            aug_inputs = aug_inputs.cuda()
-            # assert type(aug_inputs) == torch.Tensor, "Augmented Input Type Error: {}".format(type(aug_inputs))
-            preds = model(aug_inputs)
-            model_losses = criterion(preds, labels) # (tensor)[batch]
-            top1, top5 = accuracy(preds, labels, (1, 5))
-            # logger.info("Acc B/A Aug, {:.2f}->{:.2f}".format(ori_top1, top1))
-        # assert model_losses.shape == entropys.shape == log_probs.shape, \
-        #         "[Size miss match] loss: {}, entropy: {}, log_prob: {}".format(model_losses.shape, entropys.shape, log_probs.shape)
-        rewards = -model_losses + ctl_entropy_w * entropys # (tensor)[batch]
-        if baseline is None:
-            baseline = -model_losses.mean() # scalar tensor
+    with CheckpointWriter(compress=C.get().conf.get('save_compress', False)) as ckpt_writer:
+        baseline = None
+        if os.path.isfile(ctl_save_path):
+            logger.info('------Controller load------')
+            checkpoint = load_checkpoint(ctl_save_path)
+            controller.load_state_dict(checkpoint['ctl_state_dict'])
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            cnt = checkpoint['cnt']
+            mean_probs =  checkpoint['mean_probs']
+            accs =  checkpoint['accs']
+            metrics_dict = checkpoint['metrics']
+            metrics.metrics = metrics_dict
+            init_step = checkpoint['step']
+            baseline = checkpoint.get('baseline', None)
         else:
-            # assert baseline, "len(baseline): {}".format(len(baseline))
-            baseline = baseline - (1 - ctl_ema_weight) * (baseline - rewards.mean().detach())
-        # baseline = 0.
-        loss = -1 * (log_probs * (rewards - baseline)).mean() #scalar tensor
-        # Average gradient over controller_num_aggregate samples
-        loss = loss / ctl_num_aggre
-        loss.backward(retain_graph=True)
-        metrics.add_dict({
-            'loss': loss.item() * batch_size,
-            'top1': top1.item() * batch_size,
-            'top5': top5.item() * batch_size,
-        })
-        cnt += batch_size
-        if (step+1) % ctl_num_aggre == 0:
-            torch.nn.utils.clip_grad_norm_(controller.parameters(), 5.0)
-            optimizer.step()
-            controller.zero_grad()
-            # torch.cuda.empty_cache()
-            logger.info('\n[Train Controller %03d/%03d] log_prob %02f, %s', step, ctl_train_steps*ctl_num_aggre, \
-            log_probs.mean().item(), metrics / cnt
-            )
-        if step % 100 == 0 or step == ctl_train_steps * ctl_num_aggre:
-            save_pic(inputs, aug_inputs, labels, applied_policy, batch_policies, step)
-            ps = []
-            for pol in batch_policies: # (list:list:list:tuple) [batch, num_policy, n_op, 3]
-                for ops in pol:
-                    for op in ops:
-                        p = op[1]
-                        ps.append(p)
-            mean_prob = np.mean(ps)
-            mean_probs.append(mean_prob)
-            accs.append(top1.item())
-            print("Mean probability: {:.2f}".format(mean_prob))
-            torch.save({
-                        'step': step,
-                        'ctl_state_dict': controller.state_dict(),
-                        'optimizer_state_dict': optimizer.state_dict(),
-                        'metrics': dict(metrics.metrics),
-                        'cnt': cnt,
-                        'mean_probs': mean_probs,
-                        'accs': accs
-                        }, ctl_save_path)
+            logger.info('------Train Controller from scratch------')
+            mean_probs = []
+            accs = []
+            init_step = 0
+        for step in tqdm(range(init_step+1, ctl_train_steps * ctl_num_aggre + 1)):
+            batches = []
+            for _ in range(ctl_batch_multiplier):
+                try:
+                    batches.append(next(loader_iter))
+                except StopIteration:
+                    loader_iter = iter(dataloader)
+                    batches.append(next(loader_iter))
+            inputs = torch.cat([x for x, _ in batches])
+            labels = torch.cat([y for _, y in batches])
+            batch_size = len(labels)
+            inputs, labels = inputs.to(device), labels.to(device)
+            log_probs, entropys, sampled_policies = controller(inputs)
+            # evaluate model with augmented validation dataset
+            with torch.no_grad():
+                # compare Accuracy before/after augmentation
+                # ori_preds = model(inputs)
+                # ori_top1, ori_top5 = accuracy(ori_preds, labels, (1, 5))
+                batch_policies = batch_policy_decoder(sampled_policies) # (structured np.array) [batch, num_policy, n_op]
+                aug_inputs, applied_policy = augment_data(inputs, batch_policies, dataset)
+                aug_inputs = aug_inputs.to(device)
+                # assert type(aug_inputs) == torch.Tensor, "Augmented Input Type Error: {}".format(type(aug_inputs))
+                preds = model(aug_inputs)
+                model_losses = criterion(preds, labels) # (tensor)[batch]
+                top1, top5 = accuracy(preds, labels, (1, 5))
+                # logger.info("Acc B/A Aug, {:.2f}->{:.2f}".format(ori_top1, top1))
+            # assert model_losses.shape == entropys.shape == log_probs.shape, \
+            #         "[Size miss match] loss: {}, entropy: {}, log_prob: {}".format(model_losses.shape, entropys.shape, log_probs.shape)
+            # the entropy bonus stays differentiable (entropy regularization of the controller)
+            rewards = -model_losses.detach() + ctl_entropy_w * entropys # (tensor)[batch]
+            if baseline is None:
+                baseline = -model_losses.mean() # scalar tensor, no graph
+            else:
+                # assert baseline, "len(baseline): {}".format(len(baseline))
+                baseline = baseline - (1 - ctl_ema_weight) * (baseline - rewards.mean().detach()) # no graph, as before
+            # baseline = 0.
+            loss = -1 * (log_probs * (rewards - baseline)).mean() #scalar tensor
+            # Average gradient over controller_num_aggregate samples
+            loss = loss / ctl_num_aggre
+            loss.backward()
+            metrics.add_dict({
+                'loss': loss.item() * batch_size,
+                'top1': top1.item() * batch_size,
+                'top5': top5.item() * batch_size,
+            })
+            cnt += batch_size
+            if (step+1) % ctl_num_aggre == 0:
+                torch.nn.utils.clip_grad_norm_(controller.parameters(), ctl_conf.get('clip', 5.0))
+                optimizer.step()
+                controller.zero_grad()
+                # torch.cuda.empty_cache()
+                logger.info('\n[Train Controller %03d/%03d] log_prob %02f, %s', step, ctl_train_steps*ctl_num_aggre, \
+                log_probs.mean().item(), metrics / cnt
+                )
+            if step % ctl_save_interval == 0 or step == ctl_train_steps * ctl_num_aggre:
+                ckpt_writer.submit(save_pic, inputs, aug_inputs, labels, applied_policy, batch_policies, step)
+                mean_prob = batch_policies['prob'].mean()
+                mean_probs.append(mean_prob)
+                accs.append(top1.item())
+                print("Mean probability: {:.2f}".format(mean_prob))
+                ckpt_writer.save({
+                            'step': step,
+                            'ctl_state_dict': controller.state_dict(),
+                            'optimizer_state_dict': optimizer.state_dict(),
+                            'metrics': dict(metrics.metrics),
+                            'cnt': cnt,
+                            'mean_probs': mean_probs,
+                            'accs': accs,
+                            'baseline': baseline,
+                            }, ctl_save_path)
     return metrics, None #baseline.item()
 
 def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, reporter=None, metric='last', save_path=None, only_eval=False, local_rank=-1, evaluation_interval=5):
@@ -303,6 +460,7 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
     controller.eval()
     total_batch = C.get()["batch"]
     dataset = C.get()['test_dataset']
+    device = get_device()
     is_master = local_rank < 0 or dist.get_rank() == 0
     if is_master:
         add_filehandler(logger, save_path + '.log')
@@ -312,30 +470,35 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
 
     max_epoch = C.get()['epoch']
     trainsampler, trainloader, validloader, testloader_ = get_dataloaders(dataset, C.get()['batch'], dataroot, test_ratio, split_idx=cv_fold, multinode=(local_rank >= 0))
-    trainloader = AdapAugloader(trainloader, controller)
+    policy_mode = C.get().conf.get('controller', {}).get('policy_mode', 'online')
+    policy_server = None
+    if policy_mode == 'online':
+        trainloader = AdapAugloader(trainloader, controller, prefetch=C.get().conf.get('aug_prefetch', 2), dataset=dataset)
+    elif policy_mode == 'server':
+        # controller runs on cpu, batched across the DataLoader workers
+        policy_server = PolicyServer(controller, trainloader.num_workers)
+        trainloader = policy_server_loader(trainloader, policy_server, dataset)
+        policy_server.start()
+    elif policy_mode == 'table':
+        # controller runs once over the training set, before training
+        table_path = C.get()['controller'].get('policy_table', None)
+        if table_path and os.path.exists(table_path):
+            logger.info('policy table loaded from %s' % table_path)
+            policy_table = np.load(table_path, mmap_mode='r')
+        else:
+            table_path = table_path or save_path + '.policy.npy'
+            policy_table = build_policy_table(controller, trainloader.dataset, dataset, table_path, C.get()['batch'], num_samples=C.get()['controller'].get('table_samples', 8))
+            logger.info('policy table saved at %s' % table_path)
+        trainloader = policy_table_loader(trainloader, policy_table, dataset)
+    else:
+        raise ValueError('invalid policy_mode=%s' % policy_mode)
     # create a model & an optimizer
     model = get_model(C.get()['model'], num_class(dataset), local_rank=local_rank)
     model_ema = get_model(C.get()['model'], num_class(dataset), local_rank=-1)
     model_ema.eval()
     criterion_ce = criterion = CrossEntropyLabelSmooth(num_class(dataset), 0)
-    if C.get()['optimizer']['type'] == 'sgd':
-        optimizer = optim.SGD(
-            model.parameters(),
-            lr=C.get()['lr'],
-            momentum=C.get()['optimizer'].get('momentum', 0.9),
-            weight_decay=0.0,
-            nesterov=C.get()['optimizer'].get('nesterov', True)
-        )
-    elif C.get()['optimizer']['type'] == 'rmsprop':
-        optimizer = RMSpropTF(
-            model.parameters(),
-            lr=C.get()['lr'],
-            weight_decay=0.0,
-            alpha=0.9, momentum=0.9,
-            eps=0.001
-        )
-    else:
-        raise ValueError('invalid optimizer type=%s' % C.get()['optimizer']['type'])
+    optimizer, decay_params = get_optimizer(model)
+    scaler = grad_scaler()
 
     lr_scheduler_type = C.get()['lr_schedule'].get('type', 'cosine')
     if lr_scheduler_type == 'cosine':
@@ -364,7 +527,7 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
 
     if C.get()['optimizer']['ema'] > 0.0 and is_master:
         # https://discuss.pytorch.org/t/how-to-apply-exponential-moving-average-decay-for-variables/10856/4?u=ildoonet
-        ema = EMA(C.get()['optimizer']['ema'])
+        ema = EMA(C.get()['optimizer']['ema'], interval=C.get()['optimizer'].get('ema_step_interval', 1))
     else:
         ema = None
 
@@ -373,7 +536,7 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
     if save_path != 'test.pth':     # and is_master: --> should load all data(not able to be broadcasted)
         if save_path and os.path.exists(save_path):
             logger.info('%s file found. loading...' % save_path)
-            data = torch.load(save_path)
+            data = load_checkpoint(save_path)
             key = 'model' if 'model' in data else 'state_dict'
 
             if 'epoch' not in data:
@@ -385,7 +548,9 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
                 else:
                     model.load_state_dict({k if 'module.' in k else 'module.'+k: v for k, v in data[key].items()})
                 logger.info('optimizer.load_state_dict+')
-                optimizer.load_state_dict(data['optimizer'])
+                load_optimizer_state(optimizer, data['optimizer'])
+                if data.get('scaler'):
+                    scaler.load_state_dict(data['scaler'])
                 if data['epoch'] < C.get()['epoch']:
                     epoch_start = data['epoch']
                 else:
@@ -398,11 +563,15 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
             if only_eval:
                 logger.warning('model checkpoint not found. only-evaluation mode is off.')
             only_eval = False
+            if save_path and is_master:
+                write_progress(save_path, 0)
 
     tqdm_disabled = bool(os.environ.get('TASK_NAME', '')) and local_rank != 0  # KakaoBrain Environment
 
     if only_eval:
         logger.info('evaluation only+')
+        if save_path and is_master:
+            write_progress(save_path, max_epoch)
         model.eval()
         rs = dict()
         rs['train'] = run_epoch(model, trainloader, criterion, None, desc_default='train', epoch=0, writer=writers[0], is_master=is_master)
@@ -419,76 +588,86 @@ def train_and_eval_ctl(tag, controller, dataroot, test_ratio=0.0, cv_fold=0, rep
                 continue
             result['%s_%s' % (key, setname)] = rs[setname][key]
         result['epoch'] = 0
+        if policy_server is not None:
+            policy_server.close()
         return result
 
     # train loop
     best_top1 = 0
-    for epoch in range(epoch_start, max_epoch + 1):
-        model.train()
-        rs = dict()
-        rs['train'] = run_epoch(model, trainloader, criterion, optimizer, desc_default='train', epoch=epoch, writer=writers[0], verbose=(is_master and local_rank <= 0), scheduler=scheduler, ema=ema, wd=C.get()['optimizer']['decay'], tqdm_disabled=tqdm_disabled)
-        model.eval()
-
-        if math.isnan(rs['train']['loss']):
-            raise Exception('train loss is NaN.')
-
-        if ema is not None and C.get()['optimizer']['ema_interval'] > 0 and epoch % C.get()['optimizer']['ema_interval'] == 0:
-            logger.info(f'ema synced+ rank={dist.get_rank()}')
-            if ema is not None:
-                model.load_state_dict(ema.state_dict())
-            for name, x in model.state_dict().items():
-                # print(name)
-                dist.broadcast(x, 0)
-            torch.cuda.synchronize()
-            logger.info(f'ema synced- rank={dist.get_rank()}')
-
-        if is_master and (epoch % evaluation_interval == 0 or epoch == max_epoch):
-            with torch.no_grad():
-                rs['valid'] = run_epoch(model, validloader, criterion_ce, None, desc_default='valid', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
-                rs['test'] = run_epoch(model, testloader_, criterion_ce, None, desc_default='*test', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
-
+    with CheckpointWriter(compress=C.get().conf.get('save_compress', False)) as ckpt_writer:
+        for epoch in range(epoch_start, max_epoch + 1):
+            model.train()
+            rs = dict()
+            rs['train'] = run_epoch(model, trainloader, criterion, optimizer, desc_default='train', epoch=epoch, writer=writers[0], verbose=(is_master and local_rank <= 0), scheduler=scheduler, ema=ema, wd=C.get()['optimizer']['decay'] if decay_params is not None else 0.0, tqdm_disabled=tqdm_disabled, decay_params=decay_params, scaler=scaler)
+            model.eval()
+
+            if math.isnan(rs['train']['loss']):
+                raise Exception('train loss is NaN.')
+
+            if ema is not None and C.get()['optimizer']['ema_interval'] > 0 and epoch % C.get()['optimizer']['ema_interval'] == 0:
+                logger.info(f'ema synced+ rank={dist.get_rank()}')
                 if ema is not None:
-                    model_ema.load_state_dict({k.replace('module.', ''): v for k, v in ema.state_dict().items()})
-                    rs['valid'] = run_epoch(model_ema, validloader, criterion_ce, None, desc_default='valid(EMA)', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
-                    rs['test'] = run_epoch(model_ema, testloader_, criterion_ce, None, desc_default='*test(EMA)', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
-
-            logger.info(
-                f'epoch={epoch} '
-                f'[train] loss={rs["train"]["loss"]:.4f} top1={rs["train"]["top1"]:.4f} '
-                f'[valid] loss={rs["valid"]["loss"]:.4f} top1={rs["valid"]["top1"]:.4f} '
-                f'[test] loss={rs["test"]["loss"]:.4f} top1={rs["test"]["top1"]:.4f} '
-            )
-
-            if metric == 'last' or rs[metric]['top1'] > best_top1:
-                if metric != 'last':
-                    best_top1 = rs[metric]['top1']
-                for key, setname in itertools.product(['loss', 'top1', 'top5'], ['train', 'valid', 'test']):
-                    result['%s_%s' % (key, setname)] = rs[setname][key]
-                result['epoch'] = epoch
-
-                writers[1].add_scalar('valid_top1/best', rs['valid']['top1'], epoch)
-                writers[2].add_scalar('test_top1/best', rs['test']['top1'], epoch)
-
-                reporter(
-                    loss_valid=rs['valid']['loss'], top1_valid=rs['valid']['top1'],
-                    loss_test=rs['test']['loss'], top1_test=rs['test']['top1']
+                    model.load_state_dict(ema.state_dict())
+                for name, x in model.state_dict().items():
+                    # print(name)
+                    dist.broadcast(x, 0)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                logger.info(f'ema synced- rank={dist.get_rank()}')
+
+            if is_master and (epoch % evaluation_interval == 0 or epoch == max_epoch):
+                with torch.no_grad():
+                    rs['valid'] = run_epoch(model, validloader, criterion_ce, None, desc_default='valid', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
+                    rs['test'] = run_epoch(model, testloader_, criterion_ce, None, desc_default='*test', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
+
+                    if ema is not None:
+                        model_ema.load_state_dict({k.replace('module.', ''): v for k, v in ema.state_dict().items()})
+                        rs['valid'] = run_epoch(model_ema, validloader, criterion_ce, None, desc_default='valid(EMA)', epoch=epoch, writer=writers[1], verbose=is_master, tqdm_disabled=tqdm_disabled)
+                        rs['test'] = run_epoch(model_ema, testloader_, criterion_ce, None, desc_default='*test(EMA)', epoch=epoch, writer=writers[2], verbose=is_master, tqdm_disabled=tqdm_disabled)
+
+                logger.info(
+                    f'epoch={epoch} '
+                    f'[train] loss={rs["train"]["loss"]:.4f} top1={rs["train"]["top1"]:.4f} '
+                    f'[valid] loss={rs["valid"]["loss"]:.4f} top1={rs["valid"]["top1"]:.4f} '
+                    f'[test] loss={rs["test"]["loss"]:.4f} top1={rs["test"]["top1"]:.4f} '
                 )
 
-                # save checkpoint
-                if is_master and save_path:
-                    logger.info('save model@%d to %s, err=%.4f' % (epoch, save_path, 1 - result['top1_test']))#best_top1))
-                    torch.save({
-                        'epoch': epoch,
-                        'log': {
-                            'train': rs['train'].get_dict(),
-                            'valid': rs['valid'].get_dict(),
-                            'test': rs['test'].get_dict(),
-                        },
-                        'optimizer': optimizer.state_dict(),
-                        'model': model.state_dict(),
-                        'ema': ema.state_dict() if ema is not None else None,
-                    }, save_path)
-
+                if metric == 'last' or rs[metric]['top1'] > best_top1:
+                    if metric != 'last':
+                        best_top1 = rs[metric]['top1']
+                    for key, setname in itertools.product(['loss', 'top1', 'top5'], ['train', 'valid', 'test']):
+                        result['%s_%s' % (key, setname)] = rs[setname][key]
+                    result['epoch'] = epoch
+
+                    writers[1].add_scalar('valid_top1/best', rs['valid']['top1'], epoch)
+                    writers[2].add_scalar('test_top1/best', rs['test']['top1'], epoch)
+
+                    reporter(
+                        loss_valid=rs['valid']['loss'], top1_valid=rs['valid']['top1'],
+                        loss_test=rs['test']['loss'], top1_test=rs['test']['top1']
+                    )
+
+                    # save checkpoint
+                    if is_master and save_path:
+                        logger.info('save model@%d to %s, err=%.4f' % (epoch, save_path, 1 - result['top1_test']))#best_top1))
+                        ckpt_writer.save({
+                            'epoch': epoch,
+                            'log': {
+                                'train': rs['train'].get_dict(),
+                                'valid': rs['valid'].get_dict(),
+                                'test': rs['test'].get_dict(),
+                            },
+                            'optimizer': optimizer.state_dict(),
+                            'scaler': scaler.state_dict(),
+                            'model': model.state_dict(),
+                            'ema': ema.shadow if ema is not None else None,
+                        }, save_path)
+
+            if is_master and save_path:
+                ckpt_writer.submit(write_progress, save_path, epoch)    # after the checkpoint above is on disk
+
+    if policy_server is not None:
+        policy_server.close()
     del model
 
     # result['top1_test'] = best_top1
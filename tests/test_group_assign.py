@@ -0,0 +1,108 @@
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from theconf import Config as C
+
+from FastAutoAugment.data import collate
+from FastAutoAugment.group_assign import FeatureCache, feature_cache_path
+
+
+class _ImageDataset(torch.utils.data.Dataset):
+    def __init__(self, num_samples):
+        rng = np.random.RandomState(0)
+        self.imgs = [rng.randint(0, 256, (8, 8, 3), dtype=np.uint8) for _ in range(num_samples)]
+        self.targets = [i % 3 for i in range(num_samples)]
+        self.transform = None
+
+    def __len__(self):
+        return len(self.imgs)
+
+    def __getitem__(self, index):
+        img = self.imgs[index]
+        return (self.transform(img) if self.transform else img), self.targets[index]
+
+
+def _backbone():
+    torch.manual_seed(0)
+    backbone = nn.Sequential(nn.Conv2d(3, 4, 3, padding=1), nn.BatchNorm2d(4), nn.ReLU(), nn.AdaptiveAvgPool2d(1), nn.Flatten())
+    with torch.no_grad():
+        backbone[1].running_mean.uniform_(-1., 1.)
+        backbone[1].running_var.uniform_(0.5, 2.)
+    return backbone
+
+
+def test_features_use_running_statistics(tmp_path):
+    C.get()
+    C.get().conf = {'device': 'cpu'}
+    backbone = _backbone()
+    backbone.train()
+    running_mean = backbone[1].running_mean.clone()
+    cache = FeatureCache(backbone, 4, str(tmp_path / 'features.npy'))
+
+    data = torch.randn(6, 3, 8, 8)
+    # the same images, in batches of different composition
+    first = cache.lookup(12, torch.arange(6), data, torch.zeros(6, dtype=torch.long))
+    second = cache.lookup(12, torch.arange(6, 12), data.flip(0), torch.zeros(6, dtype=torch.long))
+
+    backbone.eval()
+    with torch.no_grad():
+        expected = backbone(data)
+    assert torch.allclose(first, expected, atol=1e-6)
+    assert torch.allclose(second, expected.flip(0), atol=1e-6)
+    # the frozen backbone is left in its mode, with its running statistics untouched
+    backbone.train()
+    assert torch.equal(backbone[1].running_mean, running_mean)
+
+
+def test_fill_uses_the_loader_settings(tmp_path):
+    C.get()
+    C.get().conf = {'device': 'cpu'}
+    dataset = _ImageDataset(10)
+    calls = []
+
+    def counting_collate(batch):
+        calls.append(len(batch))
+        return collate(batch)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, num_workers=0, collate_fn=counting_collate)
+    cache = FeatureCache(_backbone(), 4, str(tmp_path / 'features.npy'))
+    features, labels = cache.fill(loader, (0.5, 0.5, 0.5), (0.25, 0.25, 0.25))
+    assert calls == [4, 4, 2]
+    assert features.shape == (10, 4) and labels.tolist() == dataset.targets
+
+
+def test_cache_path_follows_the_checkpoint(tmp_path):
+    ckpt = tmp_path / 'model.pth'
+    ckpt.write_bytes(b'weights')
+    path = feature_cache_path(str(tmp_path), str(ckpt))
+    assert path == feature_cache_path(str(tmp_path), str(ckpt))
+
+    # a retrained backbone is written to the same checkpoint path
+    mtime = os.stat(str(ckpt)).st_mtime
+    os.utime(str(ckpt), (time.time(), mtime + 10))
+    assert path != feature_cache_path(str(tmp_path), str(ckpt))
+
+
+def test_cache_is_reused_and_stale_caches_removed(tmp_path):
+    C.get()
+    C.get().conf = {'device': 'cpu'}
+    dataset = _ImageDataset(10)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4, collate_fn=collate)
+    path = str(tmp_path / 'gr_features.a.npy')
+    features, _ = FeatureCache(_backbone(), 4, path).fill(loader, (0.5, 0.5, 0.5), (0.25, 0.25, 0.25))
+    features = np.array(features)
+
+    # a second run of the same backbone computes nothing
+    calls = []
+    backbone = _backbone()
+    backbone.register_forward_hook(lambda *args: calls.append(1))
+    reused, labels = FeatureCache(backbone, 4, path).fill(loader, (0.5, 0.5, 0.5), (0.25, 0.25, 0.25))
+    assert not calls
+    assert np.array_equal(reused, features) and labels.tolist() == dataset.targets
+
+    # another backbone replaces the cache
+    FeatureCache(_backbone(), 4, str(tmp_path / 'gr_features.b.npy')).fill(loader, (0.5, 0.5, 0.5), (0.25, 0.25, 0.25))
+    assert sorted(os.listdir(str(tmp_path))) == ['gr_features.b.meta.npz', 'gr_features.b.npy']
@@ -0,0 +1,53 @@
+import random
+
+import numpy as np
+import torch
+from PIL import Image
+from theconf import Config as C
+
+from FastAutoAugment.train_ctl import AdapAugloader, ControllerCollate, PolicyTableDataset, \
+    controller_transform, policy_transform
+
+
+class _Controller(object):
+    # returns the same sampled policy ids for every image
+    def __init__(self, sampled_policies):
+        self.sampled_policies = sampled_policies
+
+    def eval(self):
+        return self
+
+    def __call__(self, inputs):
+        return None, None, np.repeat(self.sampled_policies[np.newaxis], len(inputs), axis=0)
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def test_policy_modes_share_the_pipeline():
+    C.get()
+    C.get().conf = {'cutout': 16, 'device': 'cpu', 'test_dataset': 'svhn'}
+    dataset = 'svhn'
+    img = Image.fromarray(np.random.RandomState(0).randint(0, 256, (32, 32, 3), dtype=np.uint8))
+    # one sub-policy of two ops, (op id, prob id, level id)
+    sampled_policies = np.array([[[3, 7, 4], [10, 5, 6]]], dtype=np.int8)
+
+    for seed in range(5):
+        _seed(seed)
+        loader = [(controller_transform(dataset)(img).unsqueeze(0), torch.tensor([0]))]
+        online, _ = next(iter(AdapAugloader(loader, _Controller(sampled_policies), dataset=dataset)))
+
+        _seed(seed)
+        policy_client = lambda inputs: _Controller(sampled_policies)(inputs)[2]
+        collate = ControllerCollate(policy_client, policy_transform(dataset), controller_transform(dataset))
+        server, _ = collate([(img, 0)])
+
+        _seed(seed)
+        table = PolicyTableDataset([(img, 0)], sampled_policies[np.newaxis, np.newaxis], policy_transform(dataset))
+        table_img, _ = table[0]
+
+        assert torch.equal(online[0], server[0])
+        assert torch.equal(server[0], table_img)
@@ -0,0 +1,88 @@
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from FastAutoAugment.tf_port.tpu_bn import TpuBatchNormalization
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _reduce_avg(t):
+    dist.all_reduce(t, dist.ReduceOp.SUM)
+    t.mul_(1. / dist.get_world_size())
+
+
+def _unpacked_stats(input):
+    # statistics of TpuBatchNormalization before packing: one all_reduce for the mean, one for the mean-of-square
+    # (torch.batch_norm_stats is cuda only, the shard statistics are computed directly)
+    shard_mean = input.mean(dim=(0, 2, 3))
+    shard_vars = input.var(dim=(0, 2, 3), unbiased=False)
+    group_mean = shard_mean.clone()
+    _reduce_avg(group_mean)
+    group_mean_of_square = shard_vars + shard_mean * shard_mean
+    _reduce_avg(group_mean_of_square)
+    return group_mean, group_mean_of_square - group_mean * group_mean
+
+
+def _worker(rank, world_size, port, result_path):
+    os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(rank)
+        input = torch.randn(4, 8, 5, 5) * (rank + 1) + rank
+        bn = TpuBatchNormalization(8)
+        bn.train()
+
+        expected_mean, expected_var = _unpacked_stats(input)
+        group_mean, group_var = bn._group_stats(input)
+        output = bn(input)
+
+        if rank == 0:
+            full = torch.cat([torch.randn(4, 8, 5, 5, generator=torch.Generator().manual_seed(r)) * (r + 1) + r
+                              for r in range(world_size)])
+            torch.save({
+                'group_mean': group_mean, 'group_var': group_var,
+                'expected_mean': expected_mean, 'expected_var': expected_var,
+                'running_mean': bn.running_mean, 'running_var': bn.running_var,
+                'output': output.detach(), 'input': input, 'full': full,
+            }, result_path)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_group_stats_match_unpacked_all_reduce(tmp_path):
+    result_path = str(tmp_path / 'result.pth')
+    mp.spawn(_worker, args=(2, _free_port(), result_path), nprocs=2, join=True)
+    r = torch.load(result_path)
+
+    assert torch.allclose(r['group_mean'], r['expected_mean'], atol=1e-5)
+    assert torch.allclose(r['group_var'], r['expected_var'], atol=1e-4)
+    # the group statistics are the ones of the concatenated batches of both processes
+    assert torch.allclose(r['group_mean'], r['full'].mean(dim=(0, 2, 3)), atol=1e-5)
+    assert torch.allclose(r['group_var'], r['full'].var(dim=(0, 2, 3), unbiased=False), atol=1e-4)
+
+    assert torch.allclose(r['running_mean'], 0.1 * r['expected_mean'], atol=1e-6)
+    assert torch.allclose(r['running_var'], 0.9 + 0.1 * r['expected_var'], atol=1e-5)
+    expected = (r['input'] - r['expected_mean'].view(1, -1, 1, 1)) / torch.sqrt(r['expected_var'].view(1, -1, 1, 1) + 1e-5)
+    assert torch.allclose(r['output'], expected, atol=1e-4)
+
+
+def test_single_process_uses_running_stats():
+    bn = TpuBatchNormalization(8)
+    with torch.no_grad():
+        bn.running_mean.uniform_()
+        bn.running_var.uniform_(0.5, 2.)
+    bn.train()
+    input = torch.randn(4, 8, 5, 5)
+    output = bn(input)
+
+    expected = (input - bn.running_mean.view(1, -1, 1, 1)) / torch.sqrt(bn.running_var.view(1, -1, 1, 1) + bn.eps)
+    assert torch.equal(output, expected)
+    assert bn.num_batches_tracked.item() == 0